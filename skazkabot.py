@@ -15,28 +15,72 @@ Skazkabot — автоматизированный бот для ручного/
   /e:n или /event:n   - выполнить `event` n раз
   /p:n или /play:n    - выполнить `play` n раз
   /endless             - запустить бесконечный режим `endless_play`
+  /calibrate           - найти окно игры и области кнопок перед началом работы
   /?                   - показать справку
 
 Зависимости:
   - Python 3.x, библиотеки: pyautogui, opencv-python (cv2), numpy
+  - необязательно: mss (быстрый захват экрана без PIL)
 
 Предупреждение:
   - Скрипт управляет курсором и кликами по экрану — запускайте только на системе,
     где можно безопасно автоматизировать клики (например, в отдельном окне игры).
 """
 
+import asyncio
+import datetime
+import functools
+import hashlib
+import json
+import os
 import random
+import secrets
 import cv2
 import numpy as np
-import pyautogui
 import time
 import sys
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import mss
+except ImportError:
+    mss = None
 
 stRegular = 0
 stWeighted = 1
 
+
+# Квоты рун задаются по раундам: {стихия: сколько рун этой стихии может быть выбрано
+# всего к концу раунда}. None — без ограничения; стихия не указана — её руны не выбираются.
+def regular_quotas(elements):
+    """stRegular: в первом раунде все руны первой стихии, дальше — все руны всех стихий."""
+    everything = {elem: None for elem in elements}
+    return [{elem: None for elem in elements[:1]}, everything, everything]
+
+
+def weighted_quotas(elements):
+    """
+    stWeighted: в первом раунде не больше 2 рун каждой стихии, во втором — всего
+    не больше 3 рун первой и 2 второй, в третьем — все руны.
+    """
+    return [
+        {elem: 2 for elem in elements},
+        dict(zip(elements, (3, 2))),
+        {elem: None for elem in elements},
+    ]
+
+
+STRATEGIES = {
+    stRegular: regular_quotas,
+    stWeighted: weighted_quotas,
+}
+
+
 class Hero:
-    def __init__(self, name, image, priority, element=None, strategy=stRegular):
+    def __init__(self, name, image, priority, element=None, strategy=stRegular, quotas=None):
         self.name = name
         self.image = image
         self.priority = priority
@@ -48,6 +92,8 @@ class Hero:
         else:
             self.element = (element,)
         self.strategy = strategy
+        # Таблица квот по раундам; если не задана — строится по стратегии
+        self.quotas = quotas if quotas is not None else STRATEGIES[strategy](self.element)
 
     def __repr__(self):
         return f"Hero(name={self.name}, image={self.image}, priority={self.priority}, element={self.element}, strategy={self.strategy})"
@@ -69,160 +115,1641 @@ heroes = [
 ]
 
 
-def find_image_on_screen(template_path, threshold=0.79):
-    screenshot = pyautogui.screenshot()
-    screenshot = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-    template = cv2.imread(template_path)
-    result = cv2.matchTemplate(screenshot, template, cv2.TM_CCOEFF_NORMED)
-    locations = np.where(result >= threshold)
-    if locations[0].size > 0:
-        x = int(locations[1][0] + template.shape[1] / 2)
-        y = int(locations[0][0] + template.shape[0] / 2)
-        return (x, y)
-    return None
+IMG_DIR = "img"
+TEMPLATE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+class Template:
+    """Декодированный шаблон из img/ с заранее подготовленными вариантами."""
+
+    def __init__(self, name, image):
+        self.name = name
+        self.image = image
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        self.h, self.w = image.shape[:2]
+        # Масштабированные копии: scale -> (image, gray)
+        self._scaled = {1.0: (self.image, self.gray)}
+        # Варианты шаблона под масштаб игры: scale -> Template
+        self._variants = {1.0: self}
+
+    def scaled(self, scale):
+        """Возвращает (image, gray) шаблона в масштабе scale, считая копию один раз."""
+        scale = round(float(scale), 3)
+        if scale not in self._scaled:
+            w = max(1, int(round(self.w * scale)))
+            h = max(1, int(round(self.h * scale)))
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            image = cv2.resize(self.image, (w, h), interpolation=interpolation)
+            self._scaled[scale] = (image, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+        return self._scaled[scale]
+
+    def at(self, scale):
+        """Возвращает шаблон, пересчитанный под масштаб игры scale (копия считается один раз)."""
+        scale = round(float(scale), 3)
+        if scale not in self._variants:
+            self._variants[scale] = Template(self.name, self.scaled(scale)[0])
+        return self._variants[scale]
+
+    def __repr__(self):
+        return f"Template(name={self.name}, size={self.w}x{self.h})"
+
+
+class TemplateCache:
+    """
+    Реестр шаблонов: все файлы из img/ читаются и декодируются один раз.
+
+    Ключ — имя файла в нижнем регистре, поэтому 'img/press.png' находит
+    'img/press.PNG' и на регистрозависимых файловых системах.
+    """
+
+    def __init__(self, img_dir=IMG_DIR):
+        self.img_dir = img_dir
+        self.templates = {}
+        # Хэш набора файлов: по нему профиль калибровки понимает, что шаблоны не менялись
+        self.digest = None
+        # Масштаб игры относительно шаблонов (браузерный зум, DPI)
+        self.scale = 1.0
+
+    def load(self):
+        self.templates.clear()
+        digest = hashlib.sha1()
+        for file_name in sorted(os.listdir(self.img_dir)):
+            if not file_name.lower().endswith(TEMPLATE_EXTENSIONS):
+                continue
+            path = os.path.join(self.img_dir, file_name)
+            with open(path, "rb") as f:
+                data = f.read()
+            digest.update(file_name.lower().encode("utf-8"))
+            digest.update(data)
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                print(f"Не удалось прочитать шаблон {file_name}")
+                continue
+            key = file_name.lower()
+            self.templates[key] = Template(key, image)
+        self.digest = digest.hexdigest()[:16]
+        return self
+
+    def get(self, template_path):
+        """Возвращает Template по пути вида 'img/press.png' или просто имени файла."""
+        if not self.templates:
+            self.load()
+        key = os.path.basename(template_path).lower()
+        template = self.templates.get(key)
+        if template is None:
+            raise KeyError(f"Шаблон {template_path} не найден в {self.img_dir}")
+        return template.at(self.scale)
+
+    def variants(self):
+        """Все шаблоны в текущем масштабе игры."""
+        return [template.at(self.scale) for template in self.templates.values()]
+
+    def set_scale(self, scale):
+        """Переключает масштаб и сразу готовит копии всех шаблонов под него."""
+        self.scale = round(float(scale), 3)
+        self.variants()
+
+
+templates = TemplateCache()
+
+
+def px(value):
+    """Расстояние в пикселях шаблонов (масштаб 1.0) → пиксели экрана в текущем масштабе игры."""
+    return int(round(value * templates.scale))
+
+
+def offset(pos, dx, dy):
+    """Точка со смещением (dx, dy) от pos, смещение задано в масштабе 1.0."""
+    return (pos[0] + px(dx), pos[1] + px(dy))
+
+
+# Сколько значений каждой серии хранится для перцентилей (равномерная выборка)
+METRICS_RESERVOIR = 1024
+
+
+class RunningStat:
+    """
+    Серия замеров без хранения всех значений: счётчик, сумма, минимум, максимум
+    и ограниченная равномерная выборка (reservoir sampling) для перцентилей.
+    """
+
+    def __init__(self, size=METRICS_RESERVOIR):
+        self.size = size
+        self.n = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.sample = []
+
+    def add(self, value):
+        self.n += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            i = random.randrange(self.n)
+            if i < self.size:
+                self.sample[i] = value
+
+    def snapshot(self):
+        copy = RunningStat(self.size)
+        copy.n, copy.total, copy.min, copy.max, copy.sample = self.n, self.total, self.min, self.max, list(self.sample)
+        return copy
+
+
+class Metrics:
+    """
+    Замеры шагов бота и счётчики прогона.
+
+    Каждый замер (снимок, сопоставление, клик, ожидание, шаг play/event/battle/...)
+    пишется строкой JSON в файл, если он открыт через open(); итог прогона
+    печатает print_summary() и дописывает в файл close(). В памяти серии
+    хранятся как RunningStat, поэтому бесконечный режим не копит замеры.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+        self.scores = {}
+
+    def open(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _write(self, event):
+        if self._file is not None:
+            self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def record(self, kind, name, duration, **fields):
+        with self._lock:
+            self.timings.setdefault((kind, name), RunningStat()).add(duration)
+            self._write({"ts": round(time.time(), 3), "kind": kind, "name": name,
+                         "ms": round(duration * 1000, 2), **fields})
+
+    @contextmanager
+    def step(self, kind, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(kind, name, time.perf_counter() - start, **fields)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def score(self, template_name, value):
+        with self._lock:
+            self.scores.setdefault(template_name, RunningStat()).add(value)
+
+    def summary(self):
+        # Итог может запрашиваться из другого потока (пульт управления), поэтому берём снимок
+        with self._lock:
+            all_timings = {key: stat.snapshot() for key, stat in self.timings.items()}
+            counters = dict(self.counters)
+            all_scores = {name: stat.snapshot() for name, stat in self.scores.items()}
+        timings = {}
+        for (kind, name), stat in sorted(all_timings.items()):
+            p50, p90 = np.percentile(np.array(stat.sample) * 1000, [50, 90])
+            timings[f"{kind}:{name}"] = {
+                "n": stat.n, "total_s": round(stat.total, 2),
+                "p50_ms": round(float(p50), 1),
+                "p90_ms": round(float(p90), 1),
+            }
+        scores = {name: {"n": stat.n, "min": round(stat.min, 3), "mean": round(stat.total / stat.n, 3),
+                         "max": round(stat.max, 3)}
+                  for name, stat in sorted(all_scores.items())}
+        return {"elapsed_s": round(time.time() - self.started, 1), "timings": timings,
+                "counters": dict(sorted(counters.items())), "scores": scores}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Итоги прогона за {summary['elapsed_s']} с")
+        by_total = sorted(summary["timings"].items(), key=lambda item: item[1]["total_s"], reverse=True)
+        for name, t in by_total:
+            print(f"  {name:32s} n={t['n']:<6d} всего {t['total_s']:8.2f} с  p50 {t['p50_ms']:8.1f} мс  p90 {t['p90_ms']:8.1f} мс")
+        for name, value in summary["counters"].items():
+            print(f"  {name:32s} {value}")
+
+    def close(self):
+        if self._file is not None:
+            self._write({"ts": round(time.time(), 3), "kind": "summary", **self.summary()})
+            self._file.close()
+            self._file = None
+
+
+metrics = Metrics()
+
+
+def timed(kind):
+    """Декоратор: каждый вызов функции записывается в metrics как шаг kind."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.step(kind, fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Сколько секунд последний снимок экрана переиспользуется повторными запросами
+FRAME_TTL = 0.1
+
+
+def import_pyautogui():
+    """
+    Импортирует pyautogui только для работы с живым экраном.
+
+    Без графического сеанса (DISPLAY) pyautogui не импортируется вовсе,
+    а /bench и /replay должны работать и на сервере без экрана.
+    """
+    try:
+        import pyautogui
+    except Exception as e:
+        raise RuntimeError(f"pyautogui недоступен (нужен графический сеанс): {e}")
+    return pyautogui
+
+
+class PyAutoGuiCapture:
+    """Снимки через pyautogui (PIL), запасной вариант без дополнительных библиотек."""
+
+    def __init__(self):
+        self.gui = import_pyautogui()
+
+    def grab(self, region=None):
+        return cv2.cvtColor(np.array(self.gui.screenshot(region=region)), cv2.COLOR_RGB2BGR)
+
+
+class MssCapture:
+    """
+    Снимки через mss: буфер BGRA читается напрямую в NumPy без PIL и cvtColor.
+
+    Координаты совпадают с pyautogui — считаются от основного монитора.
+    """
+
+    def __init__(self):
+        if mss is None:
+            raise RuntimeError("Для захвата экрана через mss установите пакет mss")
+        # Объект mss нельзя делить между потоками
+        self._local = threading.local()
+
+    def _sct(self):
+        if not hasattr(self._local, "sct"):
+            self._local.sct = mss.mss()
+        return self._local.sct
+
+    def grab(self, region=None):
+        sct = self._sct()
+        monitor = sct.monitors[1]
+        if region is not None:
+            left, top, width, height = region
+            monitor = {"left": monitor["left"] + left, "top": monitor["top"] + top,
+                       "width": width, "height": height}
+        shot = sct.grab(monitor)
+        bgra = np.frombuffer(shot.bgra, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return np.ascontiguousarray(bgra[:, :, :3])
+
+
+CAPTURE_BACKENDS = {
+    "pyautogui": PyAutoGuiCapture,
+    "mss": MssCapture,
+}
+
+
+def make_capture(name="auto"):
+    """Создаёт захват экрана по имени; 'auto' — mss, если он установлен, иначе pyautogui."""
+    if name == "auto":
+        name = "mss" if mss is not None else "pyautogui"
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Неизвестный способ захвата экрана: {name}")
+    return CAPTURE_BACKENDS[name]()
+
+
+class FrameCache:
+    """
+    Переиспользует последний полный снимок экрана в течение ttl секунд:
+    запросы области в это время вырезаются из него без нового захвата.
+    Серый вариант кадра считается один раз на снимок.
+    """
+
+    def __init__(self, capture, ttl=FRAME_TTL):
+        self.capture = capture
+        self.ttl = ttl
+        self.frame = None
+        self.gray = None
+        self.taken = 0.0
+        # Снимок делят окна, которые обслуживаются из разных потоков
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        with self._lock:
+            self.frame = None
+            self.gray = None
+
+    def _fresh(self):
+        return self.frame is not None and time.monotonic() - self.taken <= self.ttl
+
+    def grab(self, region=None):
+        with self._lock:
+            if self._fresh():
+                if region is None:
+                    return self.frame
+                left, top, width, height = region
+                return self.frame[top:top + height, left:left + width]
+            if region is not None:
+                return self.capture.grab(region)
+            self.frame = self.capture.grab()
+            self.gray = None
+            self.taken = time.monotonic()
+            return self.frame
+
+    def grab_gray(self, region=None):
+        with self._lock:
+            frame = self.grab(region)
+            if region is None and frame is self.frame:
+                if self.gray is None:
+                    self.gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                return self.gray
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+class ScreenBackend:
+    """
+    Живой экран: снимки через выбранный захват (pyautogui, mss), клики через pyautogui.
+
+    Если задан record_dir, перед каждым кликом последний полный снимок экрана
+    сохраняется туда — из таких папок потом читает ReplayBackend.
+    """
+
+    def __init__(self, record_dir=None, capture="auto", ttl=FRAME_TTL):
+        self.gui = import_pyautogui()
+        self.record_dir = record_dir
+        self.frames = FrameCache(make_capture(capture), ttl)
+        self.recorded = 0
+        if record_dir:
+            os.makedirs(record_dir, exist_ok=True)
+
+    def screenshot(self, region=None):
+        return self.frames.grab(region)
+
+    def screenshot_gray(self, region=None):
+        return self.frames.grab_gray(region)
+
+    def size(self):
+        return self.gui.size()
+
+    def click(self, x, y):
+        if self.record_dir:
+            # Кадр на каждый клик: ReplayBackend переключает кадр на каждом клике.
+            # Последний снимок мог быть только областью, тогда экран снимается заново
+            cv2.imwrite(os.path.join(self.record_dir, f"frame{self.recorded:05d}.png"), self.frames.grab())
+            self.recorded += 1
+        self.gui.moveTo(x, y)
+        self.gui.click()
+        # После клика экран меняется, старый снимок больше не годится
+        self.frames.invalidate()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+class ReplayFinished(Exception):
+    """Записанные кадры закончились."""
+
+
+class ReplayBackend:
+    """
+    Воспроизведение без игры: кадры читаются из папки по порядку имён,
+    клики только записываются в журнал и переключают на следующий кадр.
+
+    Время виртуальное: sleep не ждёт, а сдвигает часы, поэтому таймауты
+    ожиданий отрабатывают мгновенно.
+    """
+
+    def __init__(self, frames_dir):
+        self.frames_dir = frames_dir
+        self.files = sorted(f for f in os.listdir(frames_dir) if f.lower().endswith(TEMPLATE_EXTENSIONS))
+        if not self.files:
+            raise ValueError(f"В папке {frames_dir} нет кадров")
+        self.index = 0
+        self.clicks = []
+        self.clock = 0.0
+        self._frames = {}
+
+    def frame(self):
+        file_name = self.files[self.index]
+        if file_name not in self._frames:
+            self._frames[file_name] = cv2.imread(os.path.join(self.frames_dir, file_name))
+        return self._frames[file_name]
+
+    def screenshot(self, region=None):
+        frame = self.frame()
+        if region is None:
+            return frame.copy()
+        left, top, width, height = region
+        return frame[top:top + height, left:left + width].copy()
+
+    def screenshot_gray(self, region=None):
+        return cv2.cvtColor(self.screenshot(region), cv2.COLOR_BGR2GRAY)
+
+    def size(self):
+        h, w = self.frame().shape[:2]
+        return (w, h)
+
+    def click(self, x, y):
+        self.clicks.append((self.files[self.index], x, y))
+        print(f"[replay] клик ({x}, {y}) на кадре {self.files[self.index]}")
+        if self.index + 1 >= len(self.files):
+            raise ReplayFinished()
+        self.index += 1
+
+    def sleep(self, seconds):
+        self.clock += seconds
+
+    def monotonic(self):
+        # Каждый опрос экрана тоже «занимает» немного времени, иначе циклы без sleep не закончатся
+        self.clock += 0.001
+        return self.clock
+
+
+# Живой экран или воспроизведение; выбирается при запуске, см. main
+backend = None
+
+
+# Отступ вокруг найденного шаблона при запоминании области поиска (в масштабе 1.0)
+ROI_MARGIN = 40
+# Шаблоны, по которым определяется положение окна игры
+ANCHOR_TEMPLATES = ("img/play.png", "img/event.png")
+# Стихии рун, шаблоны которых лежат в img/<стихия>.png
+RUNE_ELEMENTS = ("fire", "water", "earth", "physical")
+# Шаблоны, положение которых внутри общей области меняется (портреты, руны)
+ROI_GROUPS = {hero.image.lower(): "heroes" for hero in heroes}
+ROI_GROUPS.update({f"{elem}.png": "runes" for elem in RUNE_ELEMENTS})
+
+
+class RegionCache:
+    """
+    Области поиска шаблонов, выученные по прошлым совпадениям.
+
+    Области хранятся относительно якоря — кнопки 'Играть' или 'Событие',
+    поэтому после перемещения окна игры достаточно заново найти якорь.
+    Пока якорь не найден, области считаются в абсолютных координатах.
+    """
+
+    def __init__(self):
+        self.anchor = None
+        self.anchor_template = None
+        self.regions = {}
+        # Сколько элементов группы нашёл последний поиск по всему экрану
+        self.counts = {}
+
+    def key_for(self, template):
+        return ROI_GROUPS.get(template.name, template.name)
+
+    def origin(self):
+        return self.anchor or (0, 0)
+
+    def set_anchor(self, template_path, pos):
+        if self.anchor is None:
+            # Области, выученные до калибровки, заданы в абсолютных координатах
+            self.regions = {key: (x - pos[0], y - pos[1], w, h) for key, (x, y, w, h) in self.regions.items()}
+        elif self.anchor_template != template_path:
+            self.regions.clear()
+        self.anchor_template = template_path
+        self.anchor = pos
+        calibration_store.touch()
+
+    def get(self, template):
+        """Возвращает область (left, top, width, height) на экране или None."""
+        region = self.regions.get(self.key_for(template))
+        if region is None:
+            return None
+        ox, oy = self.origin()
+        screen_w, screen_h = screen().size()
+        left = max(0, region[0] + ox)
+        top = max(0, region[1] + oy)
+        right = min(screen_w, region[0] + ox + region[2])
+        bottom = min(screen_h, region[1] + oy + region[3])
+        if right - left < template.w or bottom - top < template.h:
+            return None
+        return (left, top, right - left, bottom - top)
+
+    def learn(self, template, pos, margin=None):
+        """Запоминает область вокруг совпадения с центром pos."""
+        if margin is None:
+            margin = px(ROI_MARGIN)
+        key = self.key_for(template)
+        left = pos[0] - template.w // 2 - margin
+        top = pos[1] - template.h // 2 - margin
+        right = left + template.w + 2 * margin
+        bottom = top + template.h + 2 * margin
+        ox, oy = self.origin()
+        if key != template.name and key in self.regions:
+            # Общая область группы расширяется до всех найденных элементов
+            x, y, w, h = self.regions[key]
+            left = min(left, x + ox)
+            top = min(top, y + oy)
+            right = max(right, x + ox + w)
+            bottom = max(bottom, y + oy + h)
+        region = (left - ox, top - oy, right - left, bottom - top)
+        if self.regions.get(key) != region:
+            self.regions[key] = region
+            calibration_store.touch()
+
+    def to_dict(self):
+        return {"anchor": self.anchor, "anchor_template": self.anchor_template,
+                "regions": {key: list(region) for key, region in self.regions.items()}}
+
+    def load_dict(self, data):
+        self.anchor = tuple(data["anchor"]) if data.get("anchor") else None
+        self.anchor_template = data.get("anchor_template")
+        self.regions = {key: tuple(region) for key, region in data.get("regions", {}).items()}
+
+
+regions = RegionCache()
+
+
+CALIBRATION_FILE = "calibration.json"
+CALIBRATION_VERSION = 1
+# Не чаще, чем раз в столько секунд, профиль переписывается при выученных областях
+CALIBRATION_SAVE_INTERVAL = 30
+
+
+class CalibrationStore:
+    """
+    Профиль калибровки на диске: положение окна (якорь), области поиска шаблонов,
+    окна многооконного режима, статистика оценок совпадений и масштаб игры.
+
+    Профили хранятся по ключу «разрешение экрана / хэш набора img/», поэтому после
+    смены монитора или шаблонов калибровка начинается заново. Файл версионирован:
+    профиль другой версии игнорируется. Запись — через временный файл, не чаще
+    CALIBRATION_SAVE_INTERVAL секунд, и в конце работы.
+
+    Тёплый старт избавляет от поиска по всему экрану только для шаблонов, чьи
+    области уже есть в профиле. Шаблоны, которые ни разу не встречались (например,
+    draw.png или портреты ещё не виденных героев), classify_screen по-прежнему
+    ищет по всему кадру, пока они выше распознанного экрана по приоритету:
+    без этого экран победы мог бы сойти за поражение.
+    """
+
+    def __init__(self, path=CALIBRATION_FILE):
+        self.path = path
+        self.enabled = False
+        self.data = {"version": CALIBRATION_VERSION, "profiles": {}}
+        self.profile = {}
+        self.instances = None
+        self.dirty = False
+        self.last_save = 0.0
+        self._lock = threading.RLock()
+
+    def key(self):
+        w, h = backend.size()
+        return f"{w}x{h}/{templates.digest}"
+
+    def load(self):
+        """Читает профиль для текущего экрана и шаблонов; возвращает True, если он найден."""
+        self.enabled = True
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Профиль калибровки {self.path} не прочитан: {e}")
+            return False
+        if data.get("version") != CALIBRATION_VERSION:
+            print(f"Профиль калибровки {self.path} другой версии, калибровка начнётся заново.")
+            return False
+        self.data = data
+        self.profile = data.get("profiles", {}).get(self.key(), {})
+        if not self.profile:
+            return False
+        regions.load_dict(self.profile.get("regions", {}))
+        templates.set_scale(self.profile.get("scale", 1.0))
+        return True
+
+    def window_rects(self):
+        return [tuple(window["rect"]) for window in self.profile.get("windows", [])]
+
+    def attach_instances(self, instances):
+        """Подставляет сохранённые области окнам с тем же прямоугольником."""
+        self.instances = instances
+        saved = {tuple(window["rect"]): window for window in self.profile.get("windows", [])}
+        for instance in instances:
+            if instance.rect in saved:
+                instance.regions.load_dict(saved[instance.rect]["regions"])
+
+    def _scores(self):
+        """Статистика оценок: сохранённая ранее, объединённая с текущим прогоном."""
+        merged = dict(self.profile.get("scores", {}))
+        for name, current in metrics.summary()["scores"].items():
+            previous = merged.get(name)
+            if previous is None:
+                merged[name] = current
+                continue
+            n = previous["n"] + current["n"]
+            merged[name] = {"n": n, "min": min(previous["min"], current["min"]),
+                            "mean": round((previous["mean"] * previous["n"] + current["mean"] * current["n"]) / n, 3),
+                            "max": max(previous["max"], current["max"])}
+        return merged
+
+    def touch(self):
+        """Отмечает изменение калибровки и сохраняет профиль, если с прошлой записи прошло достаточно времени."""
+        if not self.enabled:
+            return
+        self.dirty = True
+        if time.monotonic() - self.last_save >= CALIBRATION_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            w, h = backend.size()
+            profile = {
+                "updated": datetime.datetime.now().isoformat(timespec="seconds"),
+                "screen": [w, h],
+                "scale": templates.scale,
+                "regions": regions.to_dict(),
+                "windows": [{"rect": list(instance.rect), "regions": instance.regions.to_dict()}
+                            for instance in self.instances or []] or self.profile.get("windows", []),
+                "scores": self._scores(),
+            }
+            self.data.setdefault("profiles", {})[self.key()] = profile
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.data, f, ensure_ascii=False, indent=1)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Профиль калибровки не сохранён: {e}")
+                return
+            self.dirty = False
+            self.last_save = time.monotonic()
+
+
+calibration_store = CalibrationStore()
+
+
+class _ActiveInstance(threading.local):
+    """Окно игры, которое обслуживает текущий поток (None — весь экран)."""
+    instance = None
+
+
+_active = _ActiveInstance()
+
+
+def screen():
+    """Экран текущего потока: окно игры в многооконном режиме, иначе общий backend."""
+    instance = _active.instance
+    return instance.view if instance is not None else backend
+
+
+def current_regions():
+    """Области поиска текущего окна игры."""
+    instance = _active.instance
+    return instance.regions if instance is not None else regions
+
+
+def grab_screen(region=None):
+    """Снимает экран (или область (left, top, width, height)) и возвращает кадр BGR."""
+    with metrics.step("capture", "full" if region is None else "region"):
+        return screen().screenshot(region)
+
+
+def match_template(frame, template, threshold=0.79):
+    """Ищет шаблон на готовом кадре, возвращает центр первого совпадения или None."""
+    if frame.shape[0] < template.h or frame.shape[1] < template.w:
+        return None
+    with metrics.step("match", template.name) as fields:
+        result = cv2.matchTemplate(frame, template.image, cv2.TM_CCOEFF_NORMED)
+        fields["score"] = round(float(result.max()), 3)
+    metrics.score(template.name, fields["score"])
+    locations = np.where(result >= threshold)
+    if locations[0].size > 0:
+        x = int(locations[1][0] + template.w / 2)
+        y = int(locations[0][0] + template.h / 2)
+        return (x, y)
+    return None
+
+
+# Масштаб грубого поиска пирамидой и насколько ниже порога берутся кандидаты на нём
+PYRAMID_SCALE = 0.5
+PYRAMID_SLACK = 0.2
+PYRAMID_CANDIDATES = 5
+# Портреты героев крупные — для них по умолчанию используется пирамида
+PYRAMID_HEROES = True
+
+
+def downscale(frame, scale=PYRAMID_SCALE):
+    """Уменьшенная копия кадра для грубого поиска."""
+    return cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def match_pyramid(frame, template, threshold=0.79, small_frame=None, scale=PYRAMID_SCALE):
+    """
+    Поиск «от грубого к точному»: шаблон сначала ищется на уменьшенном кадре,
+    затем лучшие кандидаты уточняются в полном масштабе в небольшом окне вокруг.
+
+    Возвращает то же, что match_template: центр совпадения с оценкой не ниже
+    threshold в полном масштабе или None. small_frame — уже уменьшенный в scale
+    раз кадр, если он посчитан заранее для нескольких шаблонов.
+    """
+    small_template, _ = template.scaled(scale)
+    if small_frame is None:
+        small_frame = downscale(frame, scale)
+    if small_frame.shape[0] < small_template.shape[0] or small_frame.shape[1] < small_template.shape[1]:
+        return match_template(frame, template, threshold)
+    with metrics.step("match_coarse", template.name):
+        result = cv2.matchTemplate(small_frame, small_template, cv2.TM_CCOEFF_NORMED)
+    peaks = (result >= threshold - PYRAMID_SLACK) & (result == cv2.dilate(result, np.ones((3, 3), np.uint8)))
+    ys, xs = np.nonzero(peaks)
+    if ys.size == 0:
+        return None
+    best = np.argsort(result[ys, xs])[::-1][:PYRAMID_CANDIDATES]
+    # Окно уточнения покрывает ошибку округления при уменьшении
+    margin = int(np.ceil(1 / scale)) + 2
+    for i in best:
+        left = max(0, int(xs[i] / scale) - margin)
+        top = max(0, int(ys[i] / scale) - margin)
+        region = (left, top, template.w + 2 * margin, template.h + 2 * margin)
+        pos = match_in_region(frame, template, region, threshold)
+        if pos:
+            return pos
+    return None
+
+
+def match_in_region(frame, template, region, threshold=0.79):
+    """Ищет шаблон в области полного кадра, возвращает экранные координаты или None."""
+    x, y, w, h = region
+    pos = match_template(frame[y:y + h, x:x + w], template, threshold)
+    if pos:
+        return (pos[0] + x, pos[1] + y)
+    return None
+
+
+# cv2.matchTemplate отпускает GIL, поэтому независимые шаблоны можно искать в потоках
+MATCH_WORKERS = os.cpu_count() or 1
+PARALLEL_MATCHING = MATCH_WORKERS > 1
+_match_pool = None
+# Пул создаётся при первом параллельном поиске, а искать могут сразу несколько окон игры
+_match_pool_lock = threading.Lock()
+
+
+def map_templates(fn, items, parallel=PARALLEL_MATCHING):
+    """Применяет fn к каждому элементу items, при parallel — в общем пуле потоков. Порядок сохраняется."""
+    global _match_pool
+    items = list(items)
+    if not parallel or len(items) < 2:
+        return [fn(item) for item in items]
+    with _match_pool_lock:
+        if _match_pool is None:
+            _match_pool = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix="match")
+    return list(_match_pool.map(fn, items))
+
+
+# Пропускать сопоставление, если область поиска не изменилась с прошлой проверки
+SKIP_UNCHANGED = True
+
+
+class ChangeTracker:
+    """
+    Кэш результатов сопоставления по контрольной сумме области поиска.
+
+    Пока пиксели области поиска совпадают с прошлой проверкой шаблона
+    (ожидание кнопки на неподвижном экране), возвращается прошлый результат
+    без cv2.matchTemplate. Контрольная сумма (crc32) в разы дешевле сопоставления,
+    для полного кадра она считается один раз на снимок.
+    """
+
+    def __init__(self, limit=1024):
+        self.limit = limit
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._last_image = None
+        self._last_signature = None
+
+    def signature(self, image):
+        if image is self._last_image:
+            return self._last_signature
+        signature = (image.shape, zlib.crc32(np.ascontiguousarray(image)))
+        if image.base is None:
+            # Полные кадры (не срезы) встречаются много раз подряд — запоминаем
+            self._last_image, self._last_signature = image, signature
+        return signature
+
+    def scope(self):
+        """
+        Часть ключа, общая для всех поисков текущего окна: области поиска у каждого
+        окна игры свои, варианты шаблонов — у каждого масштаба.
+
+        Окно определяется по потоку, поэтому для задач пула потоков scope
+        считается заранее в вызывающем потоке и передаётся в cached().
+        """
+        return (id(current_regions()), templates.scale)
+
+    def cached(self, key, image, compute, scope=None):
+        """Возвращает compute() или прошлый результат для key, если image не изменился."""
+        if not SKIP_UNCHANGED:
+            return compute()
+        key = (scope or self.scope()) + key
+        with self._lock:
+            signature = self.signature(image)
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            metrics.count("skip:unchanged")
+            return entry[1]
+        result = compute()
+        with self._lock:
+            if len(self.entries) >= self.limit:
+                self.entries.clear()
+            self.entries[key] = (signature, result)
+        return result
+
+
+changes = ChangeTracker()
+
+
+def _count_miss(template, pos):
+    """Считает промах поиска по всему кадру; вызывается только при настоящем сопоставлении, не из кэша."""
+    if not pos:
+        metrics.count(f"miss:{template.name}")
+    return pos
+
+
+def find_image_on_screen(template_path, threshold=0.79, use_roi=True, pyramid=False):
+    template = templates.get(template_path)
+    region = current_regions().get(template) if use_roi else None
+    if region is not None:
+        # Снимаем только область, где шаблон был найден в прошлый раз
+        image = grab_screen(region)
+        pos = changes.cached((template.name, region, threshold), image,
+                             lambda: match_template(image, template, threshold))
+        if pos:
+            return (pos[0] + region[0], pos[1] + region[1])
+    frame = grab_screen()
+    if pyramid:
+        pos = changes.cached((template.name, None, threshold, True), frame,
+                             lambda: _count_miss(template, match_pyramid(frame, template, threshold)))
+    else:
+        pos = changes.cached((template.name, None, threshold), frame,
+                             lambda: _count_miss(template, match_template(frame, template, threshold)))
+    if pos and use_roi:
+        current_regions().learn(template, pos)
+    return pos
+
+
+def find_images_on_screen(template_paths, threshold=0.79, frame=None, use_roi=True, pyramid=False,
+                          parallel=PARALLEL_MATCHING, fallback=True):
+    """
+    Ищет сразу набор шаблонов на одном снимке экрана.
+
+    Возвращает словарь {template_path: (x, y) или None} для всех шаблонов.
+    Если кадр frame не передан, делается один снимок на весь набор.
+    Шаблоны, не найденные в своей области, ищутся по всему кадру: область
+    группы (ROI_GROUPS) знает только уже виденные места, а портрет может
+    появиться в новом слоте. С fallback=False поиск идёт только в выученных
+    областях, остальные шаблоны возвращаются как None.
+    С pyramid=True поиск по всему кадру идёт через match_pyramid,
+    уменьшенный кадр считается один раз на весь набор.
+    С parallel=True шаблоны сопоставляются с кадром в пуле потоков.
+    """
+    if frame is None:
+        frame = grab_screen()
+    found = {path: None for path in template_paths}
+    in_region = {}
+    if use_roi:
+        for path in template_paths:
+            region = current_regions().get(templates.get(path))
+            if region is not None:
+                in_region[path] = region
+
+    # Задачи пула выполняются в других потоках, где текущее окно игры не задано
+    scope = changes.scope()
+
+    def match_roi(path):
+        x, y, w, h = region = in_region[path]
+        crop = frame[y:y + h, x:x + w]
+        # В кэше, как и в find_image_on_screen, — позиция относительно области
+        pos = changes.cached((templates.get(path).name, region, threshold), crop,
+                             lambda: match_template(crop, templates.get(path), threshold), scope)
+        return (pos[0] + x, pos[1] + y) if pos else None
+
+    found.update(zip(in_region, map_templates(match_roi, in_region, parallel)))
+    full_search = [path for path, pos in found.items() if not pos] if fallback else []
+
+    small_frame = downscale(frame) if pyramid and full_search else None
+
+    def match_full(path):
+        template = templates.get(path)
+        if pyramid:
+            return changes.cached((template.name, None, threshold, True), frame,
+                                  lambda: _count_miss(template, match_pyramid(frame, template, threshold, small_frame)),
+                                  scope)
+        return changes.cached((template.name, None, threshold), frame,
+                              lambda: _count_miss(template, match_template(frame, template, threshold)), scope)
+
+    for path, pos in zip(full_search, map_templates(match_full, full_search, parallel)):
+        found[path] = pos
+        # Области учатся здесь, в основном потоке
+        if pos and use_roi:
+            current_regions().learn(templates.get(path), pos)
+    return found
+
+
+# Доля перекрытия рамок, при которой два совпадения считаются одной руной
+RUNE_NMS_OVERLAP = 0.3
+
+
+def _match_peaks(frame, template, threshold, elem):
+    """Локальные максимумы корреляции выше порога: список (score, x, y, elem) с центрами совпадений."""
+    if frame.shape[0] < template.h or frame.shape[1] < template.w:
+        return []
+    with metrics.step("match", template.name):
+        result = cv2.matchTemplate(frame, template.image, cv2.TM_CCOEFF_NORMED)
+    # Оставляем только пики: соседние пиксели одной руны дают почти ту же оценку
+    peaks = (result >= threshold) & (result == cv2.dilate(result, np.ones((3, 3), np.uint8)))
+    ys, xs = np.nonzero(peaks)
+    scores = result[ys, xs]
+    return [(float(score), int(x + template.w / 2), int(y + template.h / 2), elem)
+            for score, x, y in zip(scores, xs, ys)]
+
+
+def _suppress_overlaps(candidates, w, h, overlap=RUNE_NMS_OVERLAP):
+    """2D non-maximum suppression: из перекрывающихся рамок остаётся рамка с лучшей оценкой."""
+    kept = []
+    for candidate in sorted(candidates, key=lambda c: c[0], reverse=True):
+        _, x, y, _ = candidate
+        for _, kx, ky, _ in kept:
+            ix = max(0, w - abs(x - kx))
+            iy = max(0, h - abs(y - ky))
+            if ix * iy > overlap * w * h:
+                break
+        else:
+            kept.append(candidate)
+    return kept
+
+
+def _rune_grid(runes, row_height):
+    """Раскладывает руны (elem, (x, y)) по рядам сверху вниз, внутри ряда — слева направо."""
+    rows = []
+    for rune in sorted(runes, key=lambda r: r[1][1]):
+        if rows and abs(rune[1][1] - rows[-1][0][1][1]) < row_height / 2:
+            rows[-1].append(rune)
+        else:
+            rows.append([rune])
+    return [sorted(row, key=lambda r: r[1][0]) for row in rows]
+
+
+def _detect_runes_on(frame, elements, threshold, origin=(0, 0), parallel=PARALLEL_MATCHING):
+    element_templates = [templates.get(f"{elem}.png") for elem in elements]
+    w = max(template.w for template in element_templates)
+    h = max(template.h for template in element_templates)
+
+    def score(elem):
+        return _match_peaks(frame, templates.get(f"{elem}.png"), threshold, elem)
+
+    candidates = [c for found in map_templates(score, elements, parallel) for c in found]
+    kept = _suppress_overlaps(candidates, w, h)
+    runes = [(elem, (x + origin[0], y + origin[1])) for _, x, y, elem in kept]
+    return _rune_grid(runes, h)
+
+
+def detect_runes(elements=RUNE_ELEMENTS, threshold=0.94, frame=None, use_roi=True, parallel=PARALLEL_MATCHING):
+    """
+    Находит все руны за один снимок: оценивает шаблоны всех стихий на одном кадре
+    и убирает перекрывающиеся совпадения (в том числе руны, похожие на несколько стихий).
+
+    Возвращает сетку рун: список рядов сверху вниз, ряд — список (стихия, (x, y))
+    слева направо. Кадр frame, если передан, должен быть снимком всего экрана.
+
+    Область рун знает только места уже виденных рун, поэтому результат в ней
+    принимается, только если рун в ней не меньше, чем нашёл последний поиск
+    по всему кадру (поле рун не меньше прежнего). Иначе — новый поиск по всему
+    кадру, который расширяет область и обновляет размер поля.
+    """
+    sample = templates.get(f"{elements[0]}.png")
+    key = current_regions().key_for(sample)
+    region = current_regions().get(sample) if use_roi else None
+    if region is not None:
+        x, y, w, h = region
+        crop = frame[y:y + h, x:x + w] if frame is not None else grab_screen(region)
+        grid = changes.cached(("runes", tuple(elements), region, threshold), crop,
+                              lambda: _detect_runes_on(crop, elements, threshold, origin=(x, y), parallel=parallel))
+        if grid and key in current_regions().counts and sum(map(len, grid)) >= current_regions().counts[key]:
+            return grid
+    if frame is None:
+        frame = grab_screen()
+    grid = changes.cached(("runes", tuple(elements), None, threshold), frame,
+                          lambda: _detect_runes_on(frame, elements, threshold, parallel=parallel))
+    if use_roi:
+        current_regions().counts[key] = sum(map(len, grid))
+        for row in grid:
+            for elem, pos in row:
+                current_regions().learn(templates.get(f"{elem}.png"), pos)
+    return grid
+
+
+def runes_by_element(grid):
+    """Группирует сетку рун по стихиям: {стихия: [(x, y), ...]} в порядке сетки."""
+    runes = {}
+    for row in grid:
+        for elem, pos in row:
+            runes.setdefault(elem, []).append(pos)
+    return runes
+
+
+# Диапазон и шаг перебора масштаба игры (браузерный зум, DPI) при поиске якоря
+SCALE_MIN = 0.5
+SCALE_MAX = 2.0
+SCALE_STEP = 0.05
+SCALE_FINE_STEP = 0.01
+
+
+@timed("scale")
+def detect_scale(frame=None, threshold=0.79):
+    """
+    Определяет масштаб игры относительно шаблонов по якорю ('Играть' или 'Событие').
+
+    Перебор масштабов дорогой, поэтому он выполняется только когда якорь
+    не найден в текущем масштабе: грубо с шагом SCALE_STEP на уменьшенном
+    кадре (как в match_pyramid), затем с шагом SCALE_FINE_STEP в полном
+    разрешении вокруг лучшего кандидата. Найденный масштаб применяется ко всем
+    шаблонам (templates.set_scale) и сохраняется в профиле калибровки.
+    Возвращает масштаб или None, если якоря на экране нет.
+    """
+    if frame is None:
+        frame = grab_screen()
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small_frame = downscale(gray)
+
+    def best_match(image, template, scale):
+        _, template_gray = template.scaled(scale)
+        if image.shape[0] < template_gray.shape[0] or image.shape[1] < template_gray.shape[1]:
+            return -1.0, None
+        _, score, _, loc = cv2.minMaxLoc(cv2.matchTemplate(image, template_gray, cv2.TM_CCOEFF_NORMED))
+        return score, loc
+
+    best = (-1.0, None, None, None)
+    for path in ANCHOR_TEMPLATES:
+        template = templates.templates[os.path.basename(path).lower()]
+        for scale in np.arange(SCALE_MIN, SCALE_MAX + SCALE_STEP / 2, SCALE_STEP):
+            score, loc = best_match(small_frame, template, scale * PYRAMID_SCALE)
+            if score > best[0]:
+                best = (score, float(scale), template, loc)
+    _, coarse, template, loc = best
+    if template is None:
+        return None
+    # Уточнение в полном разрешении в окне вокруг грубого совпадения
+    margin = int((ROI_MARGIN + max(template.w, template.h) * SCALE_STEP * 2) * coarse)
+    left = max(0, int(loc[0] / PYRAMID_SCALE) - margin)
+    top = max(0, int(loc[1] / PYRAMID_SCALE) - margin)
+    window = gray[top:top + int(template.h * (coarse + SCALE_STEP)) + 2 * margin,
+                  left:left + int(template.w * (coarse + SCALE_STEP)) + 2 * margin]
+    best_score, best_scale = -1.0, coarse
+    for scale in np.arange(coarse - SCALE_STEP, coarse + SCALE_STEP + SCALE_FINE_STEP / 2, SCALE_FINE_STEP):
+        score, _ = best_match(window, template, scale)
+        if score > best_score:
+            best_score, best_scale = score, float(scale)
+    metrics.score("scale", best_score)
+    if best_score < threshold:
+        return None
+    best_scale = round(best_scale, 2)
+    if best_scale != templates.scale:
+        print(f"Масштаб игры: {best_scale} (было {templates.scale}), шаблоны пересчитаны.")
+        templates.set_scale(best_scale)
+        # Области выучены в старом масштабе
+        current_regions().regions.clear()
+        calibration_store.touch()
+    return best_scale
+
+
+def find_anchor(frame):
+    """Ищет якорь окна игры в текущем масштабе, при неудаче — с определением масштаба."""
+    for _ in range(2):
+        for path in ANCHOR_TEMPLATES:
+            pos = match_template(frame, templates.get(path))
+            if pos:
+                return path, pos
+        previous = templates.scale
+        if detect_scale(frame) in (None, previous):
+            return None
+    return None
+
+
+def calibrate():
+    """
+    Режим калибровки: находит окно игры по якорю ('Играть' или 'Событие')
+    и запоминает области всех шаблонов, видимых на текущем экране.
+    """
+    frame = grab_screen()
+    anchor = find_anchor(frame)
+    if anchor is None:
+        print("Окно игры не найдено, области будут выучены по ходу работы.")
+        return None
+    path, pos = anchor
+    current_regions().set_anchor(path, pos)
+    print(f"Окно игры найдено по {path}: {pos}")
+    for template in templates.variants():
+        if template.name in ROI_GROUPS:
+            # Области портретов и рун учатся только в бою
+            continue
+        pos = match_template(frame, template)
+        if pos:
+            current_regions().learn(template, pos)
+    print(f"Запомнено областей поиска: {len(current_regions().regions)}")
+    return current_regions().anchor
+
+
+class HeroIndex:
+    """
+    Герои по уровням приоритета с учётом текущего боя.
+
+    Внутри боя герои только пропадают (выбранный герой больше не доступен),
+    поэтому использованные и не найденные на экране герои запоминаются до reset().
+    select() проверяет портреты уровень за уровнем и останавливается на первом
+    уровне, где есть доступный герой, — обычно это один-два шаблона вместо всех.
+    """
+
+    def __init__(self, heroes):
+        self.tiers = {}
+        for hero in heroes:
+            self.tiers.setdefault(hero.priority, []).append(hero)
+        self.tiers = [self.tiers[priority] for priority in sorted(self.tiers)]
+        self.used = set()
+        self.missing = set()
+
+    def reset(self):
+        """Новый бой: все герои снова доступны."""
+        self.used.clear()
+        self.missing.clear()
+
+    def select(self, frame=None, threshold=0.79, use_roi=True):
+        """Возвращает (герой, позиция портрета) с наивысшим приоритетом или (None, None)."""
+        if frame is None:
+            frame = grab_screen()
+        for tier in self.tiers:
+            candidates = [hero for hero in tier if hero.name not in self.used and hero.name not in self.missing]
+            if not candidates:
+                continue
+            paths = {f"img/{hero.image}": hero for hero in candidates}
+            found = find_images_on_screen(paths, threshold, frame=frame, use_roi=use_roi, pyramid=PYRAMID_HEROES)
+            present = [(paths[path], pos) for path, pos in found.items() if pos]
+            self.missing.update(paths[path].name for path, pos in found.items() if not pos)
+            if present:
+                hero, pos = random.choice(present)
+                self.used.add(hero.name)
+                return hero, pos
+        return None, None
+
+
+def click_at(pos):
+    with metrics.step("click", "click", x=int(pos[0]), y=int(pos[1])):
+        screen().click(pos[0], pos[1])
+
+
+# Период опроса экрана при ожидании, секунды
+POLL_INTERVAL = 0.25
+# Во сколько раз уменьшается кадр для сравнения «изменился ли экран»
+SIGNATURE_SCALE = 8
+# Средняя разница яркости (0-255), выше которой кадры считаются разными
+CHANGE_TOLERANCE = 2.0
+
+
+@timed("wait")
+def wait_for(template_path, timeout=10, poll_interval=POLL_INTERVAL, threshold=0.79):
+    """Ждёт появления шаблона на экране не дольше timeout секунд, возвращает позицию или None."""
+    deadline = screen().monotonic() + timeout
+    while True:
+        pos = find_image_on_screen(template_path, threshold)
+        if pos or screen().monotonic() >= deadline:
+            return pos
+        screen().sleep(poll_interval)
+
+
+@timed("wait")
+def wait_for_gone(template_path, timeout=10, poll_interval=POLL_INTERVAL, threshold=0.79):
+    """Ждёт, пока шаблон пропадёт с экрана, не дольше timeout секунд. Возвращает True/False."""
+    deadline = screen().monotonic() + timeout
+    while True:
+        if not find_image_on_screen(template_path, threshold):
+            return True
+        if screen().monotonic() >= deadline:
+            return False
+        screen().sleep(poll_interval)
+
+
+def screen_signature(region=None, frame=None):
+    """Уменьшенный серый кадр для дешёвого сравнения двух состояний экрана."""
+    if frame is None:
+        gray = screen().screenshot_gray(region)
+    else:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    size = (max(1, w // SIGNATURE_SCALE), max(1, h // SIGNATURE_SCALE))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def signatures_differ(a, b, tolerance=CHANGE_TOLERANCE):
+    return a.shape != b.shape or float(np.mean(np.abs(a - b))) > tolerance
+
+
+@timed("wait")
+def wait_for_change(reference, timeout=2, poll_interval=POLL_INTERVAL, region=None):
+    """Ждёт, пока экран (или область) отличится от reference. Возвращает True/False."""
+    deadline = screen().monotonic() + timeout
+    while True:
+        if signatures_differ(screen_signature(region), reference):
+            return True
+        if screen().monotonic() >= deadline:
+            return False
+        screen().sleep(poll_interval)
+
+
+@timed("wait")
+def wait_for_stable(timeout=4, poll_interval=POLL_INTERVAL, stable_for=0.5, region=None):
+    """
+    Ждёт, пока экран перестанет меняться (закончатся анимации) на stable_for секунд.
+
+    Возвращает последний кадр, если экран успокоился, иначе None по истечении timeout.
+    """
+    deadline = screen().monotonic() + timeout
+    frame = grab_screen(region)
+    previous = screen_signature(frame=frame)
+    stable_since = screen().monotonic()
+    while True:
+        now = screen().monotonic()
+        if now - stable_since >= stable_for:
+            return frame
+        if now >= deadline:
+            return None
+        screen().sleep(poll_interval)
+        frame = grab_screen(region)
+        current = screen_signature(frame=frame)
+        if signatures_differ(current, previous):
+            stable_since = screen().monotonic()
+        previous = current
+
+
+def click_and_wait(pos, timeout=2, region=None):
+    """Кликает и ждёт реакции экрана (или области) не дольше timeout секунд."""
+    reference = screen_signature(region)
+    click_at(pos)
+    return wait_for_change(reference, timeout, region=region)
+
+
+def click_and_settle(pos, change_timeout=2, settle_timeout=4):
+    """Кликает, ждёт смены экрана и окончания анимаций. Возвращает успокоившийся кадр или None."""
+    click_and_wait(pos, change_timeout)
+    return wait_for_stable(settle_timeout)
+
+
+def click_on_picture(image_path, timeout=0):
+    if timeout > 0:
+        pos = wait_for(image_path, timeout)
+    else:
+        pos = find_image_on_screen(image_path)
+    # print(pos)
+    if pos:
+        click_at(pos)
+    else:
+        print(f'Изображение {image_path} не найдено.')
+    return pos
+
+# Экраны игры и шаблоны, по которым они узнаются. Порядок — приоритет,
+# если на кадре видны шаблоны нескольких экранов (кнопка 'Повторить' есть и на экране победы).
+SCREEN_STATES = (
+    ("victory", ("img/victory.png", "img/loot.png")),
+    ("draw", ("img/draw.png",)),
+    ("defeat", ("img/repeat.png",)),
+    ("battle_round", ("img/press.png", "img/ataka.png")),
+    ("hero_pick", tuple(f"img/{hero.image}" for hero in heroes)),
+    ("boss_select", ("img/bnosmile.png", "img/attack.png", "img/summon.png")),
+    # restart.png — значок обновления в браузере, он виден всегда и экран не определяет
+    ("lobby", ("img/play.png", "img/event.png")),
+)
+# Экраны, которыми заканчивается бой
+RESULT_STATES = ("victory", "draw", "defeat")
+# Таблица переходов: экран -> (действие, экраны, ожидаемые после него).
+# Действие — кнопка, которую нужно нажать, или функция found -> позиция клика или None.
+# Здесь — общие для всех режимов экраны итогов, переходы лобби и выбора босса
+# добавляют таблицы режимов (PLAY_TRANSITIONS, EVENT_TRANSITIONS).
+TRANSITIONS = {
+    "victory": ("img/loot.png", ("boss_select", "lobby")),
+    "draw": ("img/repeat.png", ("boss_select", "hero_pick", "lobby")),
+    "defeat": ("img/repeat.png", ("boss_select", "hero_pick", "lobby")),
+}
+
+
+def classify_screen(frame=None, states=None):
+    """
+    Определяет текущий экран игры по одному кадру, сопоставляя шаблоны всех экранов сразу.
+
+    С states сопоставляются только шаблоны этих экранов и экранов с более высоким
+    приоритетом (иначе экран победы с кнопкой 'Повторить' сошёл бы за поражение) —
+    так ждут известный экран, не проверяя каждый раз все портреты.
+
+    Сначала шаблоны ищутся только в выученных областях. По всему кадру ищутся
+    лишь шаблоны без областей у экранов выше найденного (чтобы не нарушить
+    приоритет), а если в областях не нашлось ничего — все шаблоны.
+    Портреты героев ищутся пирамидой (PYRAMID_HEROES).
+    Возвращает (состояние, {шаблон: позиция}) — состояние из SCREEN_STATES
+    или None, если ни один шаблон не найден.
+    """
+    checked = list(SCREEN_STATES)
+    if states is not None:
+        last = max(i for i, (state, _) in enumerate(SCREEN_STATES) if state in states)
+        checked = checked[:last + 1]
+    if frame is None:
+        frame = grab_screen()
+    found = {}
+
+    def search(groups, fallback):
+        for state, paths in groups:
+            if paths:
+                found.update(find_images_on_screen(paths, frame=frame, pyramid=PYRAMID_HEROES and state == "hero_pick",
+                                                   fallback=fallback))
+
+    def first_match():
+        return next((i for i, (_, paths) in enumerate(checked) if any(found.get(path) for path in paths)), None)
+
+    search(checked, fallback=False)
+    first = first_match()
+    if first is None:
+        # В областях ничего нет — экран незнакомый или области ещё не выучены
+        search(checked, fallback=True)
+    else:
+        search([(state, [path for path in paths if current_regions().get(templates.get(path)) is None])
+                for state, paths in checked[:first]], fallback=True)
+    first = first_match()
+    state = checked[first][0] if first is not None else None
+    if _active.instance is not None and (states is None or state is not None):
+        _active.instance.state = state
+    return state, {path: pos for path, pos in found.items() if pos}
+
+
+@timed("wait")
+def wait_for_state(states, timeout=10, poll_interval=POLL_INTERVAL):
+    """
+    Ждёт, пока экран окажется в одном из состояний states.
+
+    Пока идёт ожидание, проверяются только шаблоны экранов states (и экранов
+    с более высоким приоритетом, см. classify_screen).
+    Возвращает (состояние, найденные шаблоны). По истечении timeout экран
+    распознаётся полностью и возвращается он, даже если его нет в states.
+    """
+    deadline = screen().monotonic() + timeout
+    while True:
+        state, found = classify_screen(states=states)
+        if state in states:
+            return state, found
+        if screen().monotonic() >= deadline:
+            return classify_screen()
+        screen().sleep(poll_interval)
+
+
+def follow_transition(state, found, transitions=TRANSITIONS, timeout=3):
+    """Выполняет действие перехода из таблицы transitions для экрана state и ждёт следующий экран."""
+    action, next_states = transitions[state]
+    if callable(action):
+        pos = action(found)
+    else:
+        pos = found.get(action) or find_image_on_screen(action)
+        if pos:
+            click_at(pos)
+        else:
+            print(f'Изображение {action} не найдено.')
+    if not pos:
+        return None
+    next_state, _ = wait_for_state(next_states, timeout)
+    return next_state
+
+
+def reach_state(targets, transitions=TRANSITIONS, timeout=30):
+    """
+    Ведёт игру по таблице переходов, пока экран не окажется в одном из targets.
+
+    С любого известного экрана (лобби, выбор босса, итоги боя) бот переходит дальше
+    по таблице, поэтому неожиданный экран — например, итоги прошлого боя после
+    перезапуска — не ломает серию боёв. Возвращает последний распознанный экран.
+    """
+    deadline = screen().monotonic() + timeout
+    while True:
+        state, found = classify_screen()
+        if state in targets:
+            return state
+        if screen().monotonic() >= deadline:
+            print(f"Экран {targets} не достигнут (экран: {state}).")
+            return state
+        if state not in transitions or not follow_transition(state, found, transitions):
+            screen().sleep(POLL_INTERVAL)
+
+
+def finish_battle(timeout=3):
+    """Закрывает экран итогов боя по таблице переходов. Возвращает экран итогов или None."""
+    state, found = wait_for_state(RESULT_STATES, timeout)
+    if state not in RESULT_STATES:
+        print(f"Экран итогов боя не распознан (экран: {state}).")
+        return None
+    follow_transition(state, found)
+    if state == "victory":
+        print("Награда получена.")
+    else:
+        metrics.count("repeats")
+        print(f"Бой закончился без победы ({state}). Нажал кнопку Повторить.")
+    return state
+
+
+@timed("step")
+def press():
+    # Узнаём экран раунда по одному кадру вместо проверки кнопок по очереди
+    state, found = wait_for_state(("battle_round",), timeout=4)
+    pos = found.get("img/press.png") or found.get("img/ataka.png")
+    if state != "battle_round" or not pos:
+        print(f"Кнопки 'Жми' и 'Атака' не найдены (экран: {state}).")
+        return None
+    # Ждём, пока руны разложатся на поле
+    click_and_settle(pos, change_timeout=2, settle_timeout=4)
+    return(pos)
 
 
-def find_runes(template_path, threshold=0.94):
-    screenshot = pyautogui.screenshot()
-    screenshot = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-    template = cv2.imread(template_path)
-    result = cv2.matchTemplate(screenshot, template, cv2.TM_CCOEFF_NORMED)
-    locations = np.where(result >= threshold)
-    # print(f"Найдено {len(locations[0])} руны")
-    # print(locations)
-    points = []
-    w, h = template.shape[1], template.shape[0]
-    for pt in zip(*locations[::-1]):
-        center = (int(pt[0] + w / 2), int(pt[1] + h / 2))
-        points.append(center)
-    # С точностью 0.95 находятся фантомные руны, поэтому фильтруем близко расположенные руны
-    # Сначала сортируем по x, чтобы фильтрация была последовательной
-    points.sort(key=lambda p: p[0])
-    filtered = []
-    for p in points:
-        if not filtered or abs(p[0] - filtered[-1][0]) >= 10:
-            filtered.append(p)
-    return filtered
-
-
-def list_of_heroes():
-    found_heroes = []
-    for hero in heroes:
-        image_path = f"img/{hero.image}"
-        pos = find_image_on_screen(image_path)
-        if pos:
-            found_heroes.append(hero.name)
-    return found_heroes
+# Пауза между кликами по рунам одного раунда, секунды
+RUNE_CLICK_DELAY = 0.15
 
 
-def select_hero(hero_names):
-    # Фильтруем объекты Hero по именам
-    filtered = [hero for hero in heroes if hero.name in hero_names]
-    if not filtered:
-        return None
-    min_priority = min(hero.priority for hero in filtered)
-    candidates = [hero for hero in filtered if hero.priority == min_priority]
-    selected = random.choice(candidates)
-    return selected
+def plan_round(quotas, runes, selected):
+    """
+    Считает план кликов на раунд по сетке рун и квотам раунда.
 
+    runes — {стихия: [(x, y), ...]} в порядке сетки, selected — сколько рун каждой
+    стихии уже выбрано за бой (обновляется). Возвращает список точек для клика.
+    """
+    plan = []
+    for elem, limit in quotas.items():
+        available = runes.get(elem, [])
+        count = len(available) if limit is None else max(0, limit - selected.get(elem, 0))
+        chosen = available[:count]
+        plan.extend(chosen)
+        selected[elem] = selected.get(elem, 0) + len(chosen)
+    return plan
 
-def click_on_picture(image_path):
-    pos = find_image_on_screen(image_path)
-    # print(pos)
-    if pos:
-        pyautogui.moveTo(pos[0], pos[1])
-        pyautogui.click()
-    else:
-        print(f'Изображение {image_path} не найдено.')
-    return pos
 
-def press():
-    pos = click_on_picture("img/press.png")
-    if not pos:
-        print("Кнопка 'Жми' не найдена.")
-        pos = click_on_picture("img/ataka.png")
-        if not pos:
-            print("Кнопка 'Атака' не найдена.")
-    time.sleep(4)
-    return(pos)
+def click_plan(points, delay=RUNE_CLICK_DELAY):
+    """Кликает по точкам плана подряд с короткой паузой и ждёт, пока поле успокоится."""
+    for pos in points:
+        click_at(pos)
+        screen().sleep(delay)
+    wait_for_stable(1, stable_for=0.3)
+
+
+# Сколько секунд выбор героя должен продержаться без экрана итогов, чтобы считаться следующим туром
+TOUR_END_GRACE = 3
+
+
+@timed("wait")
+def wait_tour_end(timeout=10, poll_interval=POLL_INTERVAL):
+    """
+    Ждёт итог тура после последнего раунда: экран победы, ничьей, поражения
+    или выбор героя на следующий тур.
+
+    Портреты видны и во время раундов, поэтому сразу после исчезновения кнопки
+    'Жми' экран похож на выбор героя, хотя экран итогов ещё не появился.
+    Выбор героя засчитывается, только если раунда уже нет на экране и итогов
+    не было TOUR_END_GRACE секунд. Возвращает распознанный экран.
+    """
+    deadline = screen().monotonic() + timeout
+    pick_since = None
+    while True:
+        state, _ = classify_screen(states=RESULT_STATES + ("hero_pick",))
+        now = screen().monotonic()
+        if state in RESULT_STATES:
+            return state
+        if state == "hero_pick":
+            pick_since = pick_since if pick_since is not None else now
+            if now - pick_since >= TOUR_END_GRACE:
+                return state
+        else:
+            pick_since = None
+        if now >= deadline:
+            return state
+        screen().sleep(poll_interval)
 
 
+@timed("step")
 def battle(attacker):
-    # Для stWeighted: запоминаем сколько рун выбрано по каждому типу
-    weighted_selected = {elem: 0 for elem in attacker.element}
+    metrics.count("tours")
+    # Сколько рун каждой стихии уже выбрано за бой — квоты героя накопительные
+    selected = {}
     for round in range(3):
         print(f"Раунд {round + 1}")
-        press()
-        if round != 3:
-            # Подсчитываем руны для каждого элемента героя
-            element_runes = {}
-            for elem in attacker.element:
-                runes = find_runes(f"img/{elem}.png")
-                element_runes[elem] = runes
-                print(f"Найдено {len(runes)} рун(ы) {elem}: {runes}")
-            if attacker.strategy == stRegular:
-                found_any = False
-                for elem, runes in element_runes.items():
-                    if runes:
-                        found_any = True
-                        for rune in runes:
-                            pyautogui.moveTo(rune[0], rune[1])
-                            pyautogui.click()
-                            time.sleep(1)
-                    if round == 0:
-                        break
-                if not found_any:
-                    print(f'Руны {attacker.element} не найдены')
-            elif attacker.strategy == stWeighted:
-                # stWeighted: особый алгоритм по раундам
-                elems = list(attacker.element)
-                if round == 0:
-                    # В первом раунде — не больше 2 рун каждого типа
-                    for elem in elems:
-                        runes = element_runes[elem]
-                        count = min(2, len(runes))
-                        for rune in runes[:count]:
-                            pyautogui.moveTo(rune[0], rune[1])
-                            pyautogui.click()
-                            time.sleep(1)
-                        weighted_selected[elem] += count
-                        print(f"Выбрано {count} рун типа {elem} в первом раунде")
-                elif round == 1:
-                    # Во втором раунде — не больше 3 рун первого типа и 2 второго, учитывая уже выбранные
-                    if len(elems) > 0:
-                        elem1 = elems[0]
-                        max1 = 3 - weighted_selected[elem1]
-                        runes1 = element_runes[elem1]
-                        count1 = min(max1, len(runes1)) if max1 > 0 else 0
-                        for rune in runes1[:count1]:
-                            pyautogui.moveTo(rune[0], rune[1])
-                            pyautogui.click()
-                            time.sleep(1)
-                        weighted_selected[elem1] += count1
-                        print(f"Выбрано {count1} рун типа {elem1} во втором раунде")
-                    if len(elems) > 1:
-                        elem2 = elems[1]
-                        max2 = 2 - weighted_selected[elem2]
-                        runes2 = element_runes[elem2]
-                        count2 = min(max2, len(runes2)) if max2 > 0 else 0
-                        for rune in runes2[:count2]:
-                            pyautogui.moveTo(rune[0], rune[1])
-                            pyautogui.click()
-                            time.sleep(1)
-                        weighted_selected[elem2] += count2
-                        print(f"Выбрано {count2} рун типа {elem2} во втором раунде")
-                else:
-                    # В третьем раунде — прежний алгоритм (кликаем по всем)
-                    for elem, runes in element_runes.items():
-                        for rune in runes:
-                            pyautogui.moveTo(rune[0], rune[1])
-                            pyautogui.click()
-                            time.sleep(1)
-    time.sleep(10)
-    # Проверяем победу
-    pos = find_image_on_screen("img/victory.png")
+        if not press():
+            # Бой мог закончиться раньше — не тратим время на оставшиеся раунды
+            state, _ = classify_screen()
+            if state in RESULT_STATES or state == "hero_pick":
+                break
+        # Подсчитываем руны для каждого элемента героя по одному снимку поля
+        found_runes = runes_by_element(detect_runes())
+        for elem in attacker.element:
+            runes = found_runes.get(elem, [])
+            print(f"Найдено {len(runes)} рун(ы) {elem}: {runes}")
+        quotas = attacker.quotas[min(round, len(attacker.quotas) - 1)]
+        plan = plan_round(quotas, found_runes, selected)
+        if plan:
+            print(f"Выбираем {len(plan)} рун(ы) в раунде {round + 1}, всего выбрано: {selected}")
+            click_plan(plan)
+        else:
+            print(f'Руны {attacker.element} не найдены')
+    else:
+        state = wait_tour_end()
+    if state == "victory":
+        metrics.count("wins")
+    return state
+
+def open_play(found):
+    """Лобби → 'Игра': кнопка 'Играть' и переход к боссам для фарма."""
+    pos = click_on_picture("img/play.png")
+    if pos:
+        wait_for_stable(3)
+        click_and_settle(offset(pos, -131, 10), change_timeout=1, settle_timeout=1)
+        click_and_settle(offset(pos, -131, 10), change_timeout=1, settle_timeout=1)
+    return pos
+
+
+def pick_boss(found):
+    """Выбор босса для фарма и кнопка 'В бой'."""
+    if not click_on_picture("img/bnosmile.png", timeout=3):
+        print('Босс не найден')
+    return click_on_picture("img/attack.png", timeout=3)
+
+
+def open_event(found):
+    """Лобби → 'Событие'."""
+    pos = click_on_picture("img/event.png")
+    if pos:
+        wait_for_stable(3)
+        click_and_settle(offset(pos, -32, 40), change_timeout=3, settle_timeout=3)
     return pos
 
+
+PLAY_TRANSITIONS = {
+    **TRANSITIONS,
+    "lobby": (open_play, ("boss_select",)),
+    "boss_select": (pick_boss, ("hero_pick",)),
+}
+EVENT_TRANSITIONS = {
+    **TRANSITIONS,
+    "lobby": (open_event, ("boss_select",)),
+    "boss_select": ("img/summon.png", ("hero_pick",)),
+}
+
+
+def run_fights(n_attack, transitions):
+    """
+    Проводит n_attack боёв: до выбора героя игра ведётся по таблице переходов
+    transitions (лобби, выбор босса, итоги прошлого боя), затем идут туры боя.
+    """
+    hero_index = HeroIndex(heroes)
+    for i in range(n_attack):
+        print(f"Атака {i + 1} из {n_attack}")
+        metrics.count("battles")
+        # Портреты видны и во время раундов, поэтому бой, уже идущий на экране, тоже подходит
+        if reach_state(("hero_pick", "battle_round"), transitions) not in ("hero_pick", "battle_round"):
+            continue
+        hero_index.reset()
+        in_battle = True
+        while in_battle:
+            print("Начинаем бой")
+            # Портреты ищутся и выбранный герой кликается по одному и тому же кадру,
+            # снятому после окончания анимаций
+            frame = wait_for_stable(3)
+            attacker, pos = hero_index.select(frame)
+            print(f"Атакующий: {attacker}")
+            if not attacker:
+                print("Нет доступных героев для атаки")
+                break
+            click_at(pos)
+            state = battle(attacker)
+            if state == "victory":
+                print("Бой завершен, победа!")
+                in_battle = False
+            elif state in RESULT_STATES:
+                print("Бой завершен без победы.")
+                in_battle = False
+            else:
+                print("Следующий тур.")
+        finish_battle()
+
+
+@timed("step")
 def play(n_attack=10):
     """
     Выполняет серию боёв в игровом режиме "Игра".
@@ -240,62 +1767,12 @@ def play(n_attack=10):
             - После победы собирает награду.
         - Все действия автоматизированы с помощью поиска и кликов по изображениям на экране.
     """
-    # Ищем кнопку Игра
     print("Переходим в игру (если есть)")
     print("Количество атак:", n_attack)
-    pos = click_on_picture("img/play.png")
-    if pos:
-       time.sleep(3)
-       pyautogui.moveTo(pos[0]-131, pos[1]+10)
-       pyautogui.click()
-       time.sleep(1)
-       pyautogui.moveTo(pos[0]-131, pos[1]+10)
-       pyautogui.click()
-       time.sleep(1)
-    for i in range(n_attack): # Цикл по количеству атак
-        print(f"Атака {i + 1} из {n_attack}")   
-        # Ищем босса для фарма
-        pos = click_on_picture("img/bnosmile.png")
-        time.sleep(2)
-        if not pos:
-            print('Босс не найден')
-        
-        # Жмем кнопку В бой
-        pos = click_on_picture("img/attack.png")
-        time.sleep(3)
-        
-        # Бой
-        in_battle = True
-        while in_battle:
-            print("Начинаем бой")
-            attacker = select_hero(list_of_heroes())
-            print(f"Атакующий: {attacker}")
-            if not attacker:
-                print("Нет доступных героев для атаки")
-                break
-            if attacker:
-                pos = click_on_picture(f"img/{attacker.image}")
-                time.sleep(2)
-            else:
-                print('Шаблон атакующего не найден')
-                break
-            pos = battle(attacker)
-            if pos:
-                print("Бой завершен, победа!") 
-                in_battle = False
-            else:
-                print("Следующий тур.")
-        pos = click_on_picture("img/loot.png")
-        if pos:
-            time.sleep(2)
-        else:
-            print("Кнопка 'Забрать' не найдена, вероятно ничья или проигрыш.")
-            pos = click_on_picture("img/repeat.png")
-            if pos:
-                time.sleep(2)
-                print("Проиграли бой. Нажал кнопку Повторить.")
+    run_fights(n_attack, PLAY_TRANSITIONS)
 
 
+@timed("step")
 def event(n_attack=1):
     """
     Выполняет серию боёв в игровом событии.
@@ -312,107 +1789,586 @@ def event(n_attack=1):
             - После победы собирает награду.
         - Все действия автоматизированы с помощью поиска и кликов по изображениям на экране.
     """
-    # Ищем кнопку Событие
     print("Переходим в событие  (если есть)")
     print("Количество атак:", n_attack)
-    pos = click_on_picture("img/event.png")
-    if pos:
-       time.sleep(3)
-       pyautogui.moveTo(pos[0]-32, pos[1]+40)
-       pyautogui.click()
-       time.sleep(3)
-    for i in range(n_attack):
-        # Жмем кнопку призвать
-        pos = click_on_picture("img/summon.png")
-        time.sleep(3)
-        # Бой
-        in_battle = True
-        while in_battle:
-            print("Начинаем бой")
-            attacker = select_hero(list_of_heroes())
-            print(f"Атакующий: {attacker}")
-            if not attacker:
-                print("Нет доступных героев для атаки")
-                break
-            if attacker:
-                pos = click_on_picture(f"img/{attacker.image}")
-                time.sleep(2)
-            else:
-                print('Шаблон атакующего не найден')
-                break
-            pos = battle(attacker)
-            if pos:
-                print("Бой завершен, победа!") 
-                in_battle = False
-            else:
-                print("Следующий тур.")
-        pos = click_on_picture("img/loot.png")
-        time.sleep(2)
+    run_fights(n_attack, EVENT_TRANSITIONS)
 
+@timed("step")
 def restart():
-    # Ищем кнопку Перезапустить
-    pos = click_on_picture("img/restart.png")
+    # Ищем кнопку Перезапустить (значок обновления страницы в браузере)
+    pos = find_image_on_screen("img/restart.png")
     if pos:
-        time.sleep(5)
-        play_btn = find_image_on_screen("img/play.png")
+        # Пока страница не начала перезагружаться, на экране ещё старая кнопка 'Играть':
+        # ждём смены экрана и того, что кнопка пропадёт, и только потом — новую кнопку
+        click_and_wait(pos, timeout=5)
+        wait_for_gone("img/play.png", timeout=5)
+        play_btn = wait_for("img/play.png", timeout=5, poll_interval=1)
+        rescaled = False
         while not play_btn:
             print("Ждем кнопку 'Играть'...")
-            time.sleep(3)
-            play_btn = find_image_on_screen("img/play.png")
+            if not rescaled:
+                # Кнопки нет дольше обычного — возможно, изменился зум страницы
+                rescaled = detect_scale() is not None
+            play_btn = wait_for("img/play.png", timeout=3, poll_interval=1)
+        current_regions().set_anchor("img/play.png", play_btn)
         print("Кнопка 'Играть' найдена, игра перезапущена.")
     else:
         print("Кнопка 'Перезапустить' не найдена.")
 
-def endless_play(n_attack=15):
+class ClickScheduler:
     """
-    Запускает бесконечный цикл фарма:
-      1. Сохраняет текущее время.
-      2. Вызывает функцию play с параметром 15.
-      3. Ждёт до истечения 73 минут с момента старта, затем повторяет цикл.
+    Единая очередь ввода для всех окон: клик (перемещение мыши и нажатие)
+    выполняется целиком, пока другие окна ждут своей очереди.
     """
-    import datetime
 
-    while True:
-        start_time = datetime.datetime.now()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clicks = 0
+
+    def click(self, x, y):
+        with self._lock:
+            backend.click(x, y)
+            self.clicks += 1
+
+
+class WindowView:
+    """
+    Одно окно игры как отдельный «экран»: координаты считаются от угла окна,
+    снимки вырезаются из общего кадра всего экрана (один захват на такт FrameCache),
+    клики идут через общий ClickScheduler.
+    """
+
+    def __init__(self, rect, clicks):
+        self.rect = rect
+        self.clicks = clicks
+
+    def screenshot(self, region=None):
+        left, top, width, height = self.rect
+        window = backend.screenshot()[top:top + height, left:left + width]
+        if region is None:
+            return window
+        x, y, w, h = region
+        return window[y:y + h, x:x + w]
+
+    def screenshot_gray(self, region=None):
+        return cv2.cvtColor(self.screenshot(region), cv2.COLOR_BGR2GRAY)
+
+    def size(self):
+        return self.rect[2], self.rect[3]
+
+    def click(self, x, y):
+        self.clicks.click(self.rect[0] + x, self.rect[1] + y)
+
+    def sleep(self, seconds):
+        backend.sleep(seconds)
+
+    def monotonic(self):
+        return backend.monotonic()
+
+
+class GameInstance:
+    """Окно игры в многооконном режиме: свой прямоугольник, свои области поиска и свой экран."""
+
+    def __init__(self, name, rect, clicks):
+        self.name = name
+        self.rect = rect
+        self.view = WindowView(rect, clicks)
+        self.regions = RegionCache()
+        self.state = None
+
+    def __repr__(self):
+        return f"GameInstance(name={self.name}, rect={self.rect}, state={self.state})"
+
+
+# Поле игры относительно центра кнопки 'Играть' в масштабе 1.0: (dx, dy, ширина, высота)
+GAME_WINDOW = (-500, -450, 1000, 690)
+
+
+def os_window_rects():
+    """
+    Прямоугольники видимых окон из списка окон ОС (left, top, width, height).
+
+    Список есть только там, где pyautogui умеет перечислять окна (Windows);
+    иначе возвращается пустой список.
+    """
+    try:
+        windows = import_pyautogui().getAllWindows()
+    except (AttributeError, NotImplementedError):
+        return []
+    return [(w.left, w.top, w.width, w.height) for w in windows
+            if w.visible and not w.isMinimized and w.width > 0 and w.height > 0]
+
+
+def _contains(rect, point):
+    left, top, w, h = rect
+    return left <= point[0] < left + w and top <= point[1] < top + h
+
+
+def _overlap(a, b):
+    return (a[0] < b[0] + b[2] and b[0] < a[0] + a[2]
+            and a[1] < b[1] + b[3] and b[1] < a[1] + a[3])
+
+
+def window_around(pos, screen_w, screen_h, os_rects=()):
+    """
+    Прямоугольник окна игры с якорем в точке pos.
+
+    Берётся наименьшее окно ОС, содержащее якорь; если списка окон нет —
+    поле игры GAME_WINDOW вокруг якоря в текущем масштабе, обрезанное по экрану.
+    """
+    containing = [rect for rect in os_rects if _contains(rect, pos)]
+    if containing:
+        left, top, w, h = min(containing, key=lambda rect: rect[2] * rect[3])
+    else:
+        dx, dy, w, h = (px(v) for v in GAME_WINDOW)
+        left, top = pos[0] + dx, pos[1] + dy
+    right, bottom = min(screen_w, left + w), min(screen_h, top + h)
+    left, top = max(0, left), max(0, top)
+    return (left, top, right - left, bottom - top)
+
+
+def discover_windows(anchor="img/play.png", threshold=0.79):
+    """
+    Находит все окна игры на экране по кнопке-якорю (по умолчанию 'Играть').
+
+    Окно каждого якоря — окно ОС, в котором он лежит, или поле игры GAME_WINDOW
+    вокруг него. Пересекающиеся окна отбрасываются: иначе одно окно находило бы
+    и нажимало кнопки соседнего. Возвращает список прямоугольников
+    (left, top, width, height) слева направо, сверху вниз.
+    """
+    frame = backend.screenshot()
+    template = templates.get(anchor)
+    peaks = _suppress_overlaps(_match_peaks(frame, template, threshold, anchor), template.w, template.h)
+    screen_h, screen_w = frame.shape[:2]
+    # Окно ОС с несколькими якорями (несколько игр на одной странице) границ не даёт
+    os_rects = [rect for rect in (os_window_rects() if peaks else [])
+                if sum(_contains(rect, (x, y)) for _, x, y, _ in peaks) == 1]
+    rects = []
+    for _, x, y, _ in sorted(peaks, key=lambda peak: peak[0], reverse=True):
+        rect = window_around((x, y), screen_w, screen_h, os_rects)
+        if any(_overlap(rect, other) for other in rects):
+            print(f"Окно игры у {(x, y)} пересекается с другим окном и пропущено.")
+            continue
+        rects.append(rect)
+    return sorted(rects, key=lambda r: (r[1], r[0]))
+
+
+def make_instances(n_windows=None):
+    """
+    Создаёт GameInstance для окон игры (не больше n_windows).
+
+    Окна из профиля калибровки используются без поиска по экрану, если их хватает.
+    """
+    rects = calibration_store.window_rects()
+    if not rects or (n_windows is not None and len(rects) < n_windows):
+        rects = discover_windows()
+    if n_windows is not None and len(rects) < n_windows:
+        print(f"Найдено окон игры: {len(rects)} из {n_windows}")
+    rects = rects[:n_windows] if n_windows else rects
+    clicks = ClickScheduler()
+    instances = [GameInstance(f"окно {i + 1}", rect, clicks) for i, rect in enumerate(rects)]
+    calibration_store.attach_instances(instances)
+    return instances
+
+
+def run_instances(instances, fn, *args):
+    """
+    Выполняет fn(*args) для каждого окна в своём потоке и ждёт завершения всех.
+
+    Пока одно окно ждёт анимацию или экран, другие окна успевают искать и кликать.
+    """
+    errors = []
+
+    def worker(instance):
+        _active.instance = instance
+        try:
+            fn(*args)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            _active.instance = None
+
+    threads = [threading.Thread(target=worker, args=(instance,), name=instance.name, daemon=True)
+               for instance in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def farm_instances(instances, n_attack):
+    """restart + play во всех окнах одновременно."""
+    def farm():
         restart()
         play(n_attack)
-        elapsed = (datetime.datetime.now() - start_time).total_seconds()
-        wait_time = 73 * 60 - elapsed
-        if wait_time > 0:
-            # Показываем обновляемый progress-bar до достижения 73 минут с момента start_time
-            total = 73 * 60
-            target_end = start_time + datetime.timedelta(seconds=total)
-            bar_width = 40
+    run_instances(instances, farm)
+
+
+# Длительность цикла бесконечного фарма (от запуска play до следующего запуска), секунды
+CYCLE_SECONDS = 73 * 60
+
+
+def progress_bar(passed, total, bar_width=40):
+    """Строка прогресс-бара ожидания до следующего запуска."""
+    passed = min(max(passed, 0), total)
+    remaining = int(total - passed)
+    percent = passed / total if total > 0 else 1.0
+    filled = int(percent * bar_width)
+    bar = "#" * filled + "-" * (bar_width - filled)
+    mins = remaining // 60
+    secs = remaining % 60
+    return f"Ожидание [{bar}] {int(percent*100):3d}%  {mins:02d}:{secs:02d} до следующего запуска"
+
+
+async def run_in_thread(fn, *args):
+    """
+    Выполняет блокирующую функцию в отдельном потоке-демоне и ждёт результат.
+
+    В отличие от run_in_executor, поток-демон не задерживает выход из программы
+    по Ctrl+C посреди боя.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(e))
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+    threading.Thread(target=target, name=fn.__name__, daemon=True).start()
+    return await future
+
+
+def warm_up(instances=None):
+    """Подготовка во время ожидания: масштабированные шаблоны для пирамиды и калибровка окон."""
+    for template in templates.variants():
+        template.scaled(PYRAMID_SCALE)
+    if instances:
+        run_instances(instances, calibrate)
+    else:
+        calibrate()
+
+
+# Заголовок с токеном пульта и адреса, с которых пульт принимает запросы
+CONTROL_TOKEN_HEADER = "X-Control-Token"
+CONTROL_HOSTS = ("127.0.0.1", "localhost")
+
+
+class FarmScheduler:
+    """
+    Асинхронный цикл бесконечного фарма: restart → play → ожидание до конца цикла.
+
+    Бой идёт в отдельном потоке, ожидание — асинхронный таймер, который можно
+    прервать командой trigger. Пауза вступает в силу на границе цикла:
+    начатый бой доигрывается. Пока идёт ожидание, выполняется warm_up().
+
+    Пульт управления (serve с портом) — маленький HTTP-сервер на 127.0.0.1:
+      GET /status, GET /metrics, POST /pause, /resume, /trigger.
+    Игра открыта в браузере на той же машине, и любая страница может отправить
+    запрос на 127.0.0.1 (ссылкой или HTML-формой). Поэтому:
+      - запросы с заголовком Host или Origin не от 127.0.0.1/localhost отклоняются;
+      - команды требуют заголовок CONTROL_TOKEN_HEADER с токеном, который печатается
+        при запуске. Чужая страница не знает токена, а свой заголовок браузер
+        без разрешения CORS (его пульт не даёт) отправить не позволит.
+    """
+
+    def __init__(self, n_attack=15, cycle_seconds=CYCLE_SECONDS, instances=None):
+        self.token = secrets.token_urlsafe(16)
+        self.n_attack = n_attack
+        self.instances = instances
+        self.cycle_seconds = cycle_seconds
+        self.state = "idle"
+        self.cycle = 0
+        self.paused = False
+        self.cycle_started = None
+        self.next_run = None
+        self.last_cycle_s = None
+        self._resumed = None
+        self._triggered = None
+
+    def status(self):
+        return {
+            "state": self.state,
+            "paused": self.paused,
+            "cycle": self.cycle,
+            "n_attack": self.n_attack,
+            "last_cycle_s": self.last_cycle_s,
+            "next_run": self.next_run.isoformat(timespec="seconds") if self.next_run else None,
+            "windows": [{"name": i.name, "rect": i.rect, "state": i.state} for i in self.instances or []],
+        }
+
+    def pause(self):
+        self.paused = True
+        self._resumed.clear()
+        return self.status()
+
+    def resume(self):
+        self.paused = False
+        self._resumed.set()
+        return self.status()
+
+    def trigger(self):
+        """Запустить следующий цикл сразу, не дожидаясь конца ожидания."""
+        self._triggered.set()
+        return self.status()
+
+    def _farm(self):
+        metrics.count("cycles")
+        if self.instances:
+            farm_instances(self.instances, self.n_attack)
+            return
+        restart()
+        play(self.n_attack)
+
+    async def _cooldown(self):
+        # Показываем обновляемый progress-bar до конца цикла, ожидание прерывается командой trigger
+        self._triggered.clear()
+        while True:
+            passed = (datetime.datetime.now() - self.cycle_started).total_seconds()
+            if passed >= self.cycle_seconds:
+                break
+            print(f"\r{progress_bar(passed, self.cycle_seconds)}", end="", flush=True)
             try:
-                while True:
-                    now = datetime.datetime.now()
-                    if now >= target_end:
-                        break
-                    passed = (now - start_time).total_seconds()
-                    if passed < 0:
-                        passed = 0
-                    if passed > total:
-                        passed = total
-                    remaining = int(total - passed)
-                    percent = passed / total if total > 0 else 1.0
-                    filled = int(percent * bar_width)
-                    bar = "#" * filled + "-" * (bar_width - filled)
-                    mins = remaining // 60
-                    secs = remaining % 60
-                    print(f"\rОжидание [{bar}] {int(percent*100):3d}%  {mins:02d}:{secs:02d} до следующего запуска", end="", flush=True)
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                # Позволяем пользователю прервать ожидание клавишей
-                print("\nОжидание прервано пользователем.")
-            else:
-                # Завершаем строку прогресс-бара после завершения ожидания
-                print()
+                await asyncio.wait_for(self._triggered.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            print("\nОжидание прервано командой trigger.", end="")
+            break
+        # Завершаем строку прогресс-бара после завершения ожидания
+        print()
+
+    async def run(self):
+        self._resumed = asyncio.Event()
+        self._triggered = asyncio.Event()
+        if not self.paused:
+            self._resumed.set()
+        while True:
+            if self.paused:
+                self.state = "paused"
+                print("Фарм на паузе.")
+            await self._resumed.wait()
+            self.cycle += 1
+            self.state = "farming"
+            self.cycle_started = datetime.datetime.now()
+            self.next_run = self.cycle_started + datetime.timedelta(seconds=self.cycle_seconds)
+            await run_in_thread(self._farm)
+            self.last_cycle_s = round((datetime.datetime.now() - self.cycle_started).total_seconds(), 1)
+            # Пока игра ждёт, готовим кэши и уточняем области поиска. Это отдельное
+            # состояние: калибровка работает с экраном, и Ctrl+C в это время не должен
+            # запускать следующий цикл параллельно с ней
+            self.state = "warm_up"
+            await run_in_thread(warm_up, self.instances)
+            self.state = "cooldown"
+            await self._cooldown()
+
+    def _local(self, headers):
+        """Запрос адресован пульту напрямую, а не пришёл со сторонней страницы."""
+        host = headers.get("host", "").rsplit(":", 1)[0]
+        origin = headers.get("origin")
+        if host not in CONTROL_HOSTS:
+            return False
+        return origin is None or origin.split("://", 1)[-1].rsplit(":", 1)[0] in CONTROL_HOSTS
+
+    async def _handle(self, reader, writer):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        method = request_line[0] if request_line else ""
+        path = request_line[1] if len(request_line) > 1 else "/"
+        routes = {
+            "/status": ("GET", self.status),
+            "/metrics": ("GET", metrics.summary),
+            "/pause": ("POST", self.pause),
+            "/resume": ("POST", self.resume),
+            "/trigger": ("POST", self.trigger),
+        }
+        if not self._local(headers):
+            code, reason, body = 403, "Forbidden", {"error": "запрос не с 127.0.0.1"}
+        elif method == "POST" and not secrets.compare_digest(headers.get(CONTROL_TOKEN_HEADER.lower(), ""),
+                                                            self.token):
+            code, reason, body = 403, "Forbidden", {"error": f"нужен заголовок {CONTROL_TOKEN_HEADER}"}
+        elif path in routes and routes[path][0] == method:
+            code, reason, body = 200, "OK", routes[path][1]()
+        elif path in routes:
+            code, reason, body = 405, "Method Not Allowed", {"error": f"{path} принимает только {routes[path][0]}"}
+        else:
+            code, reason, body = 404, "Not Found", {"error": f"неизвестная команда {path}", "commands": list(routes)}
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        allow = f"Allow: {routes[path][0]}\r\n" if code == 405 else ""
+        writer.write(f"HTTP/1.0 {code} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n{allow}"
+                     f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, control_port=None):
+        """Запускает цикл фарма и, если задан порт, пульт управления."""
+        if control_port is None:
+            await self.run()
+            return
+        server = await asyncio.start_server(self._handle, "127.0.0.1", control_port)
+        print(f"Пульт управления: http://127.0.0.1:{control_port}/status")
+        print(f"Токен для команд (заголовок {CONTROL_TOKEN_HEADER}): {self.token}")
+        async with server:
+            await self.run()
+
+
+def endless_play(n_attack=15, control_port=None, instances=None):
+    """
+    Запускает бесконечный цикл фарма:
+      1. Сохраняет текущее время.
+      2. Вызывает функцию play с параметром n_attack.
+      3. Ждёт до истечения 73 минут с момента старта, затем повторяет цикл.
+
+    Цикл выполняется FarmScheduler на asyncio; с control_port доступен пульт управления,
+    с instances бои идут во всех окнах игры одновременно.
+    Ctrl+C во время ожидания, как и раньше, сразу запускает следующий цикл.
+    """
+    scheduler = FarmScheduler(n_attack, instances=instances)
+    while True:
+        try:
+            asyncio.run(scheduler.serve(control_port))
+        except KeyboardInterrupt:
+            if scheduler.state != "cooldown":
+                raise
+            # Позволяем пользователю прервать ожидание клавишей
+            print("\nОжидание прервано пользователем.")
+
+
+def _percentiles(samples):
+    if not samples:
+        return "нет замеров"
+    ms = np.array(samples) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return f"n={len(ms)}  p50={p50:.1f}  p90={p90:.1f}  p99={p99:.1f}  max={ms.max():.1f} мс"
+
+
+def _near(found, expected, tolerance):
+    return found is not None and abs(found[0] - expected[0]) <= tolerance and abs(found[1] - expected[1]) <= tolerance
+
+
+def _count_points(found, expected, tolerance):
+    """Сопоставляет найденные точки с размеченными: возвращает (верных, лишних, пропущенных)."""
+    unmatched = list(expected)
+    hits = 0
+    for point in found:
+        for target in unmatched:
+            if _near(point, target, tolerance):
+                unmatched.remove(target)
+                hits += 1
+                break
+    return hits, len(found) - hits, len(unmatched)
+
+
+def benchmark(frames_dir, threshold=0.79, rune_threshold=0.94, use_roi=False):
+    """
+    Замеры скорости и точности распознавания на записанных кадрах.
+
+    Для каждого кадра из frames_dir замеряются find_image_on_screen (по размеченным
+    шаблонам), выбор героя HeroIndex.select (как в начале боя) и detect_runes.
+    Разметка берётся из frames_dir/labels.json:
+
+        {"frame00001.png": {"templates": {"press.png": [x, y], "loot.png": null},
+                            "heroes": ["Горыныч"],
+                            "runes": {"fire": [[x, y], ...]}}}
+
+    "heroes" — портреты, видимые на кадре: выбор верен, если выбран один из них
+    с наивысшим приоритетом. Без разметки печатаются только задержки.
+    """
+    global backend, SKIP_UNCHANGED
+    labels_path = os.path.join(frames_dir, "labels.json")
+    labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path, encoding="utf-8") as f:
+            labels = json.load(f)
+    replay = ReplayBackend(frames_dir)
+    previous_backend, backend = backend, replay
+    # Замеряется само сопоставление: соседние записанные кадры почти одинаковы,
+    # и пропуск неизменившихся областей выдавал бы попадания в кэш за задержку
+    previous_skip, SKIP_UNCHANGED = SKIP_UNCHANGED, False
+    timings = {"find_image_on_screen": [], "HeroIndex.select": [], "detect_runes": []}
+    # Счётчики точности: [верно, лишних, пропущено]
+    accuracy = {"templates": [0, 0, 0], "heroes": [0, 0, 0], "runes": [0, 0, 0]}
+    try:
+        for index, file_name in enumerate(replay.files):
+            replay.index = index
+            label = labels.get(file_name, {})
+
+            for name, expected in label.get("templates", {}).items():
+                start = time.perf_counter()
+                pos = find_image_on_screen(name, threshold, use_roi=use_roi)
+                timings["find_image_on_screen"].append(time.perf_counter() - start)
+                template = templates.get(name)
+                if expected is None:
+                    accuracy["templates"][0 if pos is None else 1] += 1
+                elif _near(pos, expected, max(template.w, template.h) / 2):
+                    accuracy["templates"][0] += 1
+                else:
+                    accuracy["templates"][2] += 1
+
+            start = time.perf_counter()
+            hero, _ = HeroIndex(heroes).select(threshold=threshold, use_roi=use_roi)
+            timings["HeroIndex.select"].append(time.perf_counter() - start)
+            if "heroes" in label:
+                visible = [h for h in heroes if h.name in label["heroes"]]
+                best = {h.name for h in visible if h.priority == min(v.priority for v in visible)}
+                if (hero.name in best) if hero else not best:
+                    accuracy["heroes"][0] += 1
+                elif hero:
+                    accuracy["heroes"][1] += 1
+                else:
+                    accuracy["heroes"][2] += 1
+
+            start = time.perf_counter()
+            grid = detect_runes(threshold=rune_threshold, use_roi=use_roi)
+            timings["detect_runes"].append(time.perf_counter() - start)
+            if "runes" in label:
+                found_runes = runes_by_element(grid)
+                for elem in set(found_runes) | set(label["runes"]):
+                    tolerance = templates.get(f"{elem}.png").w / 2
+                    counts = _count_points(found_runes.get(elem, []), label["runes"].get(elem, []), tolerance)
+                    for i, value in enumerate(counts):
+                        accuracy["runes"][i] += value
+    finally:
+        backend = previous_backend
+        SKIP_UNCHANGED = previous_skip
+
+    print(f"Кадров: {len(replay.files)}, порог {threshold}, порог рун {rune_threshold}")
+    for name, samples in timings.items():
+        print(f"  {name:22s} {_percentiles(samples)}")
+    if labels:
+        for name, (hits, extra, missed) in accuracy.items():
+            total = hits + extra + missed
+            share = hits / total * 100 if total else 100.0
+            print(f"  точность {name:10s} верно {hits}, лишних {extra}, пропущено {missed} ({share:.1f}%)")
+    return timings, accuracy
 
 
 if __name__ == "__main__":
     n_attack_event = 0
     n_attack_play = 15
     endless = False
+    calibration = False
+    replay_dir = None
+    bench_dir = None
+    record_dir = None
+    threshold = 0.79
+    rune_threshold = 0.94
+    capture_name = "auto"
+    metrics_path = None
+    control_port = None
+    n_windows = None
+    profile_path = CALIBRATION_FILE
+    frame_ttl = FRAME_TTL
 
     help_text = (
         "Использование:\n"
@@ -420,6 +2376,18 @@ if __name__ == "__main__":
         "  /e:n или /event:n   - количество атак для event (по умолчанию 0)\n"
         "  /p:n или /play:n    - количество атак для play (по умолчанию 15)\n"
         "  /endless            - бесконечный режим фарма (play каждые 73 минуты)\n"
+        "  /calibrate          - найти окно игры и области кнопок перед началом работы\n"
+        "  /profile:файл       - файл профиля калибровки (по умолчанию calibration.json)\n"
+        "  /capture:способ     - захват экрана: auto, mss или pyautogui (по умолчанию auto)\n"
+        "  /frame-ttl:сек      - сколько переиспользовать последний снимок (по умолчанию 0.1)\n"
+        "  /windows:n          - играть в n окнах игры одновременно (0 — во всех найденных)\n"
+        "  /control:порт       - пульт управления для /endless на 127.0.0.1:порт (status, metrics, pause, resume, trigger)\n"
+        "  /metrics:файл       - писать замеры шагов в файл JSON lines\n"
+        "  /record:папка       - сохранять снимок экрана перед каждым кликом\n"
+        "  /replay:папка       - прогнать бота по записанным кадрам без игры\n"
+        "  /bench:папка        - замерить скорость и точность распознавания на кадрах\n"
+        "  /threshold:x        - порог совпадения шаблонов для /bench (по умолчанию 0.79)\n"
+        "  /rune-threshold:x   - порог совпадения рун для /bench (по умолчанию 0.94)\n"
         "  /?                  - показать эту справку\n"
         "Пример:\n"
         "  python skazkabot.py /e:5 /p:20\n"
@@ -445,6 +2413,52 @@ if __name__ == "__main__":
                 sys.exit(1)
         elif arg == "/endless":
             endless = True
+        elif arg == "/calibrate":
+            calibration = True
+        elif arg.startswith("/profile:"):
+            profile_path = arg.split(":", 1)[1]
+        elif arg.startswith("/capture:"):
+            capture_name = arg.split(":", 1)[1]
+        elif arg.startswith("/frame-ttl:"):
+            try:
+                frame_ttl = float(arg.split(":", 1)[1])
+            except ValueError:
+                print("Ошибка: неверный формат для /frame-ttl:сек")
+                print(help_text)
+                sys.exit(1)
+        elif arg.startswith("/windows:"):
+            try:
+                n_windows = int(arg.split(":", 1)[1])
+            except ValueError:
+                print("Ошибка: неверный формат для /windows:n")
+                print(help_text)
+                sys.exit(1)
+        elif arg.startswith("/control:"):
+            try:
+                control_port = int(arg.split(":", 1)[1])
+            except ValueError:
+                print("Ошибка: неверный формат для /control:порт")
+                print(help_text)
+                sys.exit(1)
+        elif arg.startswith("/metrics:"):
+            metrics_path = arg.split(":", 1)[1]
+        elif arg.startswith("/record:"):
+            record_dir = arg.split(":", 1)[1]
+        elif arg.startswith("/replay:"):
+            replay_dir = arg.split(":", 1)[1]
+        elif arg.startswith("/bench:"):
+            bench_dir = arg.split(":", 1)[1]
+        elif arg.startswith("/threshold:") or arg.startswith("/rune-threshold:"):
+            try:
+                value = float(arg.split(":", 1)[1])
+            except ValueError:
+                print(f"Ошибка: неверный формат для {arg.split(':', 1)[0]}:x")
+                print(help_text)
+                sys.exit(1)
+            if arg.startswith("/threshold:"):
+                threshold = value
+            else:
+                rune_threshold = value
         elif arg == "/?":
             print(help_text)
             sys.exit(0)
@@ -453,12 +2467,69 @@ if __name__ == "__main__":
             print(help_text)
             sys.exit(1)
 
-    if endless:
-        endless_play(17)
+    # Все шаблоны декодируются один раз до начала работы
+    templates.load()
+    print(f"Загружено шаблонов: {len(templates.templates)}")
+
+    if bench_dir:
+        benchmark(bench_dir, threshold, rune_threshold)
+        sys.exit(0)
+    if replay_dir:
+        backend = ReplayBackend(replay_dir)
     else:
-        if n_attack_play > 0:
-            restart()
-            play(n_attack_play)
-        if n_attack_event > 0:
-            restart()
-            event(n_attack_event)
+        try:
+            backend = ScreenBackend(record_dir, capture_name, frame_ttl)
+        except (RuntimeError, ValueError) as e:
+            print(f"Ошибка: {e}")
+            sys.exit(1)
+
+    if metrics_path:
+        metrics.open(metrics_path)
+    if not replay_dir:
+        # Тёплый старт: области поиска и окна из прошлых запусков
+        calibration_store.path = profile_path
+        if calibration_store.load():
+            print(f"Загружен профиль калибровки: {len(regions.regions)} областей поиска")
+        else:
+            # Холодный старт: якорь окна и масштаб игры по первому снимку
+            anchor = find_anchor(grab_screen())
+            if anchor:
+                regions.set_anchor(*anchor)
+            else:
+                print("Кнопки 'Играть'/'Событие' не видно, масштаб игры определится позже.")
+
+    instances = None
+    if n_windows is not None:
+        instances = make_instances(n_windows or None)
+        if not instances:
+            print("Окна игры не найдены: нужна видимая кнопка 'Играть' в каждом окне.")
+            sys.exit(1)
+        print(f"Окна игры: {instances}")
+
+    def run(fn, *args):
+        if instances:
+            run_instances(instances, fn, *args)
+        else:
+            fn(*args)
+
+    def run_mode(mode, n_attack):
+        restart()
+        mode(n_attack)
+
+    try:
+        if calibration:
+            run(calibrate)
+
+        if endless:
+            endless_play(17, control_port, instances)
+        else:
+            if n_attack_play > 0:
+                run(run_mode, play, n_attack_play)
+            if n_attack_event > 0:
+                run(run_mode, event, n_attack_event)
+    except ReplayFinished:
+        print(f"Воспроизведение завершено, кликов: {len(backend.clicks)}")
+    finally:
+        calibration_store.save()
+        metrics.print_summary()
+        metrics.close()
@@ -0,0 +1,111 @@
+import itertools
+
+import pytest
+
+import skazkabot
+from skazkabot import Hero, plan_round, stRegular, stWeighted
+
+
+def baseline_round(strategy, elements, round, runes, selected):
+    """Число кликов по стихиям в раунде так, как их делал прежний battle() с ветками stRegular/stWeighted."""
+    clicks = {}
+    if strategy == stRegular:
+        for elem in elements:
+            clicks[elem] = len(runes[elem])
+            if round == 0:
+                break
+    elif round == 0:
+        for elem in elements:
+            clicks[elem] = min(2, len(runes[elem]))
+    elif round == 1:
+        for elem, limit in zip(elements, (3, 2)):
+            left = limit - selected[elem]
+            clicks[elem] = min(left, len(runes[elem])) if left > 0 else 0
+    else:
+        for elem in elements:
+            clicks[elem] = len(runes[elem])
+    for elem, n in clicks.items():
+        selected[elem] += n
+    return clicks
+
+
+def runes_on_field(counts):
+    """Сетка рун по стихиям: у каждой стихии свой ряд, чтобы по точке было видно стихию."""
+    return {elem: [(x * 100, row * 100) for x in range(n)] for row, (elem, n) in enumerate(counts.items())}
+
+
+@pytest.mark.parametrize("strategy", [stRegular, stWeighted])
+@pytest.mark.parametrize("elements", [("fire", "physical"), ("water",)])
+def test_plan_round_matches_baseline_clicks(strategy, elements):
+    hero = Hero("test", "test.png", 1, elements, strategy=strategy)
+    for fields in itertools.product([0, 1, 2, 4], repeat=len(elements) * 3):
+        rounds = [dict(zip(elements, fields[i:i + len(elements)])) for i in range(0, len(fields), len(elements))]
+        selected, expected_selected = {}, {elem: 0 for elem in elements}
+        for round, counts in enumerate(rounds):
+            runes = runes_on_field(counts)
+            plan = plan_round(hero.quotas[round], runes, selected)
+            rows = {elem: row * 100 for row, elem in enumerate(counts)}
+            clicked = {elem: sum(1 for _, y in plan if y == rows[elem]) for elem in elements}
+            expected = baseline_round(strategy, elements, round, runes, expected_selected)
+            assert clicked == {elem: expected.get(elem, 0) for elem in elements}, (rounds, round)
+
+
+def test_suppress_overlaps_keeps_best_of_overlapping_boxes():
+    candidates = [
+        (0.95, 100, 100, "fire"),
+        (0.97, 104, 102, "water"),   # та же руна, похожа на две стихии — остаётся лучшая
+        (0.96, 200, 100, "fire"),    # соседняя руна не перекрывается
+        (0.90, 140, 100, "earth"),   # перекрытие меньше порога — отдельная руна
+    ]
+    kept = skazkabot._suppress_overlaps(candidates, 40, 40)
+    assert sorted(kept) == sorted([(0.97, 104, 102, "water"), (0.96, 200, 100, "fire"), (0.90, 140, 100, "earth")])
+
+
+def test_suppress_overlaps_empty():
+    assert skazkabot._suppress_overlaps([], 40, 40) == []
+
+
+def test_rune_grid_orders_rows_top_down_and_runes_left_to_right():
+    runes = [("fire", (300, 205)), ("water", (100, 100)), ("earth", (200, 98)), ("fire", (100, 200))]
+    assert skazkabot._rune_grid(runes, 40) == [
+        [("water", (100, 100)), ("earth", (200, 98))],
+        [("fire", (100, 200)), ("fire", (300, 205))],
+    ]
+
+
+def test_rune_grid_empty():
+    assert skazkabot._rune_grid([], 40) == []
+
+
+@pytest.fixture
+def unit_scale():
+    previous, skazkabot.templates.scale = skazkabot.templates.scale, 1.0
+    yield
+    skazkabot.templates.scale = previous
+
+
+def test_window_around_uses_smallest_os_window_with_anchor(unit_scale):
+    os_rects = [(0, 0, 1920, 1080), (960, 0, 960, 1080), (0, 0, 960, 1080)]
+    assert skazkabot.window_around((1860, 500), 1920, 1080, os_rects) == (960, 0, 960, 1080)
+    assert skazkabot.window_around((900, 500), 1920, 1080, os_rects) == (0, 0, 960, 1080)
+
+
+def test_window_around_falls_back_to_game_field_clipped_to_screen(unit_scale):
+    dx, dy, w, h = skazkabot.GAME_WINDOW
+    assert skazkabot.window_around((1000, 600), 1920, 1080) == (1000 + dx, 600 + dy, w, h)
+    left, top, width, height = skazkabot.window_around((100, 100), 1920, 1080)
+    assert (left, top) == (0, 0)
+    assert (width, height) == (100 + dx + w, 100 + dy + h)
+    left, top, width, height = skazkabot.window_around((1800, 1000), 1920, 1080)
+    assert (left + width, top + height) == (1920, 1080)
+
+
+def test_window_around_scales_game_field(unit_scale):
+    skazkabot.templates.scale = 0.5
+    dx, dy, w, h = skazkabot.GAME_WINDOW
+    assert skazkabot.window_around((1000, 600), 1920, 1080) == (1000 + dx // 2, 600 + dy // 2, w // 2, h // 2)
+
+
+def test_overlap():
+    assert skazkabot._overlap((0, 0, 100, 100), (50, 50, 100, 100))
+    assert not skazkabot._overlap((0, 0, 100, 100), (100, 0, 100, 100))